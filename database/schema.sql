@@ -33,5 +33,21 @@ CREATE TABLE comments (
     `id` varchar (50) NOT NULL UNIQUE,
     `blog_id` varchar (50) NOT NULL REFERENCES blogs (`id`),
     `user_id` varchar (50) NOT NULL REFERENCES users (`id`),
+    `content` text NOT NULL,
+    `html_content` text NOT NULL DEFAULT '',
+    `created_at` real NOT NULL,
+    PRIMARY KEY (`id`)
+);
+
+-- an existing database is migrated by `python -m www.backfill`, which adds html_content and fills it
+
+
+CREATE INDEX idx_comments_created_at ON comments (`created_at`);
+
+
+CREATE TABLE rendered_markdown (
+    `id` varchar (40) NOT NULL,
+    `html` text NOT NULL,
+    `created_at` real NOT NULL,
     PRIMARY KEY (`id`)
 );
\ No newline at end of file
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+compare the database backends of www.orm on the find_all/find hot paths.
+
+usage: python test/bench_backends.py [rounds]
+
+the odbc backend is skipped if aioodbc or the SQLite3 ODBC driver is not installed.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import www.orm as orm
+from www.models import User, Blog
+
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "database", "schema.sql")
+USERS = 50
+BLOGS = 2000
+
+
+def create_database(path):
+    import sqlite3
+    conn = sqlite3.connect(path)
+    with open(SCHEMA, encoding="utf-8") as f:
+        conn.executescript(f.read())
+    conn.executemany("insert into users (id, email, password, admin, name, image, created_at) "
+                     "values (?, ?, ?, ?, ?, ?, ?)",
+                     [(str(i), "test{}@example.com".format(i), "1234567890", False, "Test" + str(i), "about:blank", i)
+                      for i in range(USERS)])
+    conn.executemany("insert into blogs (id, user_id, title, summary, content, created_at) values (?, ?, ?, ?, ?, ?)",
+                     [(str(i), str(i % USERS), "Blog" + str(i), "summary " * 10, "content " * 200, i)
+                      for i in range(BLOGS)])
+    conn.commit()
+    conn.close()
+
+
+async def timeit(name, func, rounds):
+    await func()
+    start = time.perf_counter()
+    for i in range(rounds):
+        await func()
+    elapsed = time.perf_counter() - start
+    print("  {:<24} {:>10.1f} ops/s {:>10.3f} ms/op".format(name, rounds / elapsed, elapsed * 1000 / rounds))
+
+
+async def bench(loop, backend, database, rounds):
+    try:
+        await orm.create_pool(loop, database, backend)
+    except Exception as e:
+        print("{}: skipped ({})".format(backend, e))
+        return
+    print("{}:".format(backend))
+    try:
+        await timeit("find", lambda: User.find(str(USERS // 2)), rounds)
+        await timeit("find_all (page of 10)",
+                     lambda: Blog.find_all(orderBy="created_at desc", limit=(BLOGS // 2, 10)), rounds)
+        await timeit("find_all (100 rows)",
+                     lambda: Blog.find_all("created_at < ?", [100], orderBy="created_at desc"), rounds // 10 or 1)
+        await timeit("find (20 concurrent)",
+                     lambda: asyncio.gather(*(User.find(str(i)) for i in range(20))), rounds // 20 or 1)
+    finally:
+        await orm.close_pool()
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with tempfile.TemporaryDirectory() as path:
+        database = os.path.join(path, "bench.db")
+        create_database(database)
+        for backend in orm.BACKENDS:
+            loop.run_until_complete(bench(loop, backend, database, rounds))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
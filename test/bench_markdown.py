@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+time www.markdown2 on a synthetic corpus, per document and per set of extras.
+
+usage: python test/bench_markdown.py [--rounds N] [--output results.json] [--baseline baseline.json]
+
+the corpus is generated from a fixed seed, so results of the same code are comparable between runs.
+results are written as json (to stdout without --output), a table goes to stderr.
+with --baseline, the median times are compared with a previous output and the exit status is 1 if any
+document got slower by more than --threshold.
+the caches of highlighted code blocks and of lexers are cleared before every conversion, so that
+highlighting is measured, unless --warm-caches is given.
+"""
+
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import os
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from www import markdown2
+
+WORDS = ("the of and to in is that for it as was with be by on not he this are or his from at which but have an they "
+         "you were her all she there would their we him been has when who will more no if out so said what up its about "
+         "into than them can only other new some could time these two may then do first any my now such like our over "
+         "markdown render python server cache block event loop request response template database").split()
+
+EXTRAS = {
+    "none":               None,
+    "fenced-code-blocks": ["fenced-code-blocks"],
+    "footnotes":          ["footnotes"],
+    "tables":             ["tables"],
+    "all":                ["fenced-code-blocks", "footnotes", "tables", "header-ids", "toc", "smarty-pants",
+                           "cuddled-lists", "nofollow"],
+}
+
+
+def sentence(rng, words=(6, 20)):
+    s = " ".join(rng.choice(WORDS) for i in range(rng.randint(*words)))
+    return s[0].upper() + s[1:] + "."
+
+
+def paragraph(rng, sentences=(2, 6)):
+    return " ".join(sentence(rng) for i in range(rng.randint(*sentences)))
+
+
+def inline(rng):
+    """a paragraph with emphasis, code spans and inline links"""
+    parts = []
+    for i in range(rng.randint(3, 6)):
+        s = sentence(rng)
+        kind = rng.randrange(5)
+        if kind == 0:
+            s = "*{}* {}".format(rng.choice(WORDS), s)
+        elif kind == 1:
+            s = "**{}** {}".format(rng.choice(WORDS), s)
+        elif kind == 2:
+            s = "`{}()` {}".format(rng.choice(WORDS), s)
+        elif kind == 3:
+            s = "[{}](http://example.com/{}) {}".format(rng.choice(WORDS), rng.randrange(1000), s)
+        parts.append(s)
+    return " ".join(parts)
+
+
+def code_block(rng, fenced=True, lang=None):
+    lines = ["def {}({}):".format(rng.choice(WORDS), ", ".join(rng.sample(WORDS, 2)))]
+    for i in range(rng.randint(3, 15)):
+        lines.append("    {} = {}({}) * {}  # {}".format(rng.choice(WORDS), rng.choice(WORDS), rng.randrange(100),
+                                                     rng.randrange(10), rng.choice(WORDS)))
+    lines.append("    return <{}> & {}".format(rng.choice(WORDS), rng.choice(WORDS)))
+    if fenced:
+        return "```{}\n{}\n```".format(lang or "", "\n".join(lines))
+    return "\n".join("    " + line for line in lines)
+
+
+def table(rng, rows=(3, 20), columns=(2, 6)):
+    n = rng.randint(*columns)
+    lines = ["| " + " | ".join(rng.choice(WORDS).title() for i in range(n)) + " |",
+             "|" + "|".join(rng.choice(("---", ":---", ":---:", "---:")) for i in range(n)) + "|"]
+    for i in range(rng.randint(*rows)):
+        lines.append("| " + " | ".join(rng.choice((rng.choice(WORDS), "`{}`".format(rng.choice(WORDS)),
+                                                   "*{}*".format(rng.choice(WORDS)), str(rng.randrange(10000))))
+                                      for j in range(n)) + " |")
+    return "\n".join(lines)
+
+
+def bullet_list(rng, items=(3, 8)):
+    lines = []
+    for i in range(rng.randint(*items)):
+        lines.append("- " + sentence(rng))
+        if rng.random() < 0.3:
+            lines.extend("    - " + sentence(rng) for j in range(rng.randint(1, 3)))
+    return "\n".join(lines)
+
+
+def post(rng, blocks):
+    """a post mixing headers, paragraphs, lists, quotes and code"""
+    parts = ["# " + sentence(rng, (3, 8))[:-1]]
+    for i in range(blocks):
+        kind = rng.random()
+        if i % 12 == 11:
+            parts.append("## " + sentence(rng, (2, 6))[:-1])
+        elif kind < 0.55:
+            parts.append(inline(rng) if rng.random() < 0.5 else paragraph(rng))
+        elif kind < 0.7:
+            parts.append(bullet_list(rng))
+        elif kind < 0.8:
+            parts.append("> " + paragraph(rng, (1, 3)))
+        elif kind < 0.9:
+            parts.append(code_block(rng, fenced=rng.random() < 0.5))
+        else:
+            parts.append("1. {}\n2. {}\n3. {}".format(sentence(rng), sentence(rng), sentence(rng)))
+    return "\n\n".join(parts) + "\n"
+
+
+def link_heavy(rng, blocks):
+    parts = []
+    for i in range(blocks):
+        links = []
+        for j in range(rng.randint(4, 10)):
+            kind = rng.randrange(4)
+            word = rng.choice(WORDS)
+            if kind == 0:
+                links.append("[{}][ref{}]".format(word, rng.randrange(50)))
+            elif kind == 1:
+                links.append("[{}](http://example.com/{}/{} \"{}\")".format(word, word, j, rng.choice(WORDS)))
+            elif kind == 2:
+                links.append("<http://example.com/{}>".format(rng.randrange(1000)))
+            else:
+                links.append("![{}][img{}]".format(word, rng.randrange(10)))
+        parts.append(sentence(rng) + " " + " and ".join(links) + " " + sentence(rng))
+    parts.extend("[ref{}]: http://example.com/ref/{} \"Reference {}\"".format(i, i, i) for i in range(50))
+    parts.extend("[img{}]: http://example.com/img/{}.png".format(i, i) for i in range(10))
+    return "\n\n".join(parts) + "\n"
+
+
+def footnote_heavy(rng, blocks):
+    parts = [paragraph(rng) + "[^{}]".format(i) for i in range(blocks)]
+    parts.extend("[^{}]: {}".format(i, paragraph(rng, (1, 2))) for i in range(blocks))
+    return "\n\n".join(parts) + "\n"
+
+
+def pathological(rng):
+    """inputs which stress the regular expressions: deep nesting, unmatched markers and long lines"""
+    parts = [
+        # deeply nested lists and quotes
+        "\n".join("    " * i + "- level {}".format(i) for i in range(30)),
+        "\n".join(">" * i + " quote level {}".format(i) for i in range(1, 30)),
+        # unmatched emphasis and brackets
+        " ".join("*{}".format(rng.choice(WORDS)) for i in range(400)),
+        " ".join("_{}_{}".format(rng.choice(WORDS), rng.choice(WORDS)) for i in range(400)),
+        "[" * 200 + "x" + "]" * 150,
+        " ".join("[{}]".format(rng.choice(WORDS)) for i in range(400)),
+        # long backtick runs and a very long line
+        " ".join("`" * rng.randint(1, 4) + rng.choice(WORDS) for i in range(400)),
+        " ".join(rng.choice(WORDS) for i in range(5000)),
+        # html soup and entities
+        "\n".join("<div><span>{}</span> &amp; &{}; <{}".format(rng.choice(WORDS), rng.choice(WORDS), rng.choice(WORDS))
+                  for i in range(200)),
+    ]
+    return "\n\n".join(parts) + "\n"
+
+
+def corpus(seed=0):
+    """the benchmark documents: name => (text, names of the extras sets it is converted with)"""
+    rng = random.Random(seed)
+    common = ["none", "all"]
+    return {
+        "short_post":       (post(rng, 8), common),
+        "medium_post":      (post(rng, 80), common + ["fenced-code-blocks", "footnotes", "tables"]),
+        "huge_post":        (post(rng, 1200), common),
+        "code_heavy":       ("\n\n".join(code_block(rng, fenced=i % 2 == 0) for i in range(150)) + "\n",
+                             common + ["fenced-code-blocks"]),
+        "code_highlighted": ("\n\n".join(code_block(rng, lang="python") for i in range(40)) + "\n",
+                             ["fenced-code-blocks"]),
+        "table_heavy":      ("\n\n".join(table(rng) for i in range(60)) + "\n", common + ["tables"]),
+        "link_heavy":       (link_heavy(rng, 200), common),
+        "footnote_heavy":   (footnote_heavy(rng, 150), common + ["footnotes"]),
+        "pathological":     (pathological(rng), common),
+    }
+
+
+def clear_caches():
+    """forget the highlighted code blocks and the lexers, which markdown2 keeps between conversions"""
+    markdown2._highlighted.clear()
+    markdown2._pygments_lexers.clear()
+
+
+def measure(text, extras, rounds, min_time, warm=False):
+    """
+    median and min seconds of converting `text`, over `rounds` runs or more until `min_time` has passed,
+    with the caches cleared before each run unless `warm`.
+    """
+    markdown2.Markdown(extras=extras).convert(text)
+    times = []
+    start = time.perf_counter()
+    while len(times) < rounds or time.perf_counter() - start < min_time:
+        if not warm:
+            clear_caches()
+        t = time.perf_counter()
+        markdown2.Markdown(extras=extras).convert(text)
+        times.append(time.perf_counter() - t)
+    return statistics.median(times), min(times), len(times)
+
+
+def peak_memory(text, extras):
+    clear_caches()
+    tracemalloc.start()
+    try:
+        markdown2.Markdown(extras=extras).convert(text)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(args):
+    results = []
+    for name, (text, extras_names) in corpus(args.seed).items():
+        if args.documents and name not in args.documents:
+            continue
+        size = len(text.encode("utf-8"))
+        for extras_name in extras_names:
+            if args.extras and extras_name not in args.extras:
+                continue
+            result = {"document": name, "extras": extras_name, "bytes": size}
+            try:
+                median, best, runs = measure(text, EXTRAS[extras_name], args.rounds, args.min_time,
+                                             args.warm_caches)
+            except Exception as e:
+                result["error"] = "{}: {}".format(type(e).__name__, e)
+                print("  {:<18} {:<20} error: {}".format(name, extras_name, result["error"]), file=sys.stderr)
+                results.append(result)
+                continue
+            result.update(median_ms=median * 1000, min_ms=best * 1000, runs=runs, mb_per_s=size / median / 1e6)
+            if args.memory:
+                result["peak_kb"] = peak_memory(text, EXTRAS[extras_name]) / 1024
+            print("  {:<18} {:<20} {:>8} B {:>10.2f} ms {:>8.2f} MB/s {:>10}".format(
+                    name, extras_name, size, result["median_ms"], result["mb_per_s"],
+                    "{:.0f} KB".format(result["peak_kb"]) if "peak_kb" in result else "-"), file=sys.stderr)
+            results.append(result)
+
+    totals = {}
+    for result in results:
+        if "error" not in result:
+            total = totals.setdefault(result["extras"], {"bytes": 0, "median_ms": 0.0})
+            total["bytes"] += result["bytes"]
+            total["median_ms"] += result["median_ms"]
+    for total in totals.values():
+        total["mb_per_s"] = total["bytes"] / total["median_ms"] / 1000
+    return {
+        "markdown2":   markdown2.__version__,
+        "python":      platform.python_version(),
+        "machine":     platform.machine(),
+        "seed":        args.seed,
+        "warm_caches": args.warm_caches,
+        "results":     results,
+        "totals":      totals,
+    }
+
+
+def compare(report, baseline, threshold):
+    """print the median time ratios against `baseline`, return the number of regressions above threshold"""
+    previous = {(r["document"], r["extras"]): r for r in baseline["results"] if "error" not in r}
+    regressions = 0
+    print("compared with baseline (markdown2 {}, python {}):".format(baseline.get("markdown2"),
+                                                                     baseline.get("python")), file=sys.stderr)
+    for result in report["results"]:
+        before = previous.get((result["document"], result["extras"]))
+        if before is None or "error" in result:
+            continue
+        ratio = result["median_ms"] / before["median_ms"]
+        mark = ""
+        if ratio > 1 + threshold:
+            mark = "  REGRESSION"
+            regressions += 1
+        elif ratio < 1 - threshold:
+            mark = "  faster"
+        print("  {:<18} {:<20} {:>10.2f} ms -> {:>10.2f} ms {:>7.2f}x{}".format(
+                result["document"], result["extras"], before["median_ms"], result["median_ms"], ratio, mark),
+              file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark www.markdown2 on a synthetic corpus")
+    parser.add_argument("--rounds", type=int, default=5, help="minimum conversions per document and extras")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum seconds per document and extras")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the corpus")
+    parser.add_argument("--documents", nargs="*", help="only these documents")
+    parser.add_argument("--extras", nargs="*", help="only these extras sets: " + ", ".join(EXTRAS))
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="skip the tracemalloc peak")
+    parser.add_argument("--warm-caches", action="store_true",
+                        help="keep the highlighted code blocks cached between runs, measuring cache hits")
+    parser.add_argument("--output", help="write the json results to this file instead of stdout")
+    parser.add_argument("--baseline", help="json results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if report["seed"] != baseline.get("seed"):
+            print("the baseline was run with another corpus seed", file=sys.stderr)
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+check that Markdown.convert_incremental renders random documents, and edits of them, like Markdown.convert.
+
+usage: python test/test_markdown_incremental.py [seed]
+"""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from www import markdown2
+
+PIECES = [
+    "# Title {n}", "Setext {n}\n=========", "Sub {n}\n---------", "## Section {n} ##",
+    "A paragraph with *em*, **strong**, `code {n}`, a [ref link][r{m}] and [inline](http://x/{n} \"t\").",
+    "Another line with <span>html</span> & ampersands < and > 3 and an ![img][r{m}].",
+    "- item {n}\n- item b\n    - nested {n}\n    - nested b",
+    "- loose item {n}\n\n- loose item 2\n\n    continued para in item\n\n- third",
+    "1. one {n}\n2. two\n\n3. three",
+    "> quote {n}\n> more\nlazy continuation\n\n> second para of quote",
+    "    code block {n}\n    more code\n\n\n    after two blanks",
+    "```\ndef f():\n\n    return {n}\n```",
+    "<div>\nraw html block {n}\n\n<p>inside</p>\n</div>",
+    "<!-- comment {n} -->",
+    "***",
+    "[r{m}]: http://example.com/{m} \"Title {m}\"",
+    "Text with footnote[^f{m}] ref.",
+    "[^f{m}]: The footnote {m} text.",
+    "| a | b |\n|---|---|\n| {n} | x |",
+    "Line with trailing spaces  \nbreak and \\*escaped\\* stars and a_b_c.",
+    "Term with \"quotes\" -- and ... ellipsis",
+    "para\n- cuddled {n}\n- list",
+]
+
+EXTRAS = [
+    None,
+    ["fenced-code-blocks"],
+    ["footnotes", "tables", "smarty-pants"],
+    ["toc", "fenced-code-blocks", "footnotes"],
+    ["cuddled-lists", "header-ids", "code-friendly", "tables", "wiki-tables"],
+    ["nofollow", "markdown-in-html", "fenced-code-blocks"],
+]
+
+
+def document(rng, blocks):
+    return "\n\n".join(rng.choice(PIECES).format(n=i, m=rng.randint(0, 3)) for i in range(blocks))
+
+
+def check(seed=0, documents=200, edits=4):
+    """convert documents and edits of one of their blocks, return the number of mismatches"""
+    rng = random.Random(seed)
+    mismatches = 0
+    for i in range(documents):
+        extras = rng.choice(EXTRAS)
+        cache = markdown2.BlockCache()
+        text = document(rng, rng.randint(1, 25))
+        for j in range(edits):
+            expected = markdown2.Markdown(extras=extras).convert(text)
+            # skip the documents which convert itself leaves hashes in
+            if "md5-" not in expected:
+                html = markdown2.Markdown(extras=extras).convert_incremental(text, cache)
+                if html != expected or html._toc != expected._toc:
+                    mismatches += 1
+                    print("mismatch, extras: {}\n{}\n".format(extras, text))
+            parts = text.split("\n\n")
+            parts[rng.randrange(len(parts))] = rng.choice(PIECES).format(n=rng.randint(100, 200), m=rng.randint(0, 3))
+            text = "\n\n".join(parts)
+    return mismatches
+
+
+if __name__ == '__main__':
+    mismatches = check(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    print("mismatches: {}".format(mismatches))
+    sys.exit(1 if mismatches else 0)
@@ -10,10 +10,10 @@ from www.models import *
 
 async def insert():
     await orm.create_pool(loop, "../database/sqlite.db")
-    for i in range(1, 5):
-        u = User(id=str(i), name='Test' + str(i), email='test' + str(i) + '@example.com', password='1234567890',
-                 image='about:blank')
-        await u.save_data()
+    users = [User(id=str(i), name='Test' + str(i), email='test' + str(i) + '@example.com', password='1234567890',
+                  image='about:blank')
+             for i in range(1, 5)]
+    await User.save_all(users)
 
 
 if __name__ == '__main__':
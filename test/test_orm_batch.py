@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+check the batch writes and transactions of www.orm on a temporary sqlite database:
+save_all, upsert_all, the change notifications, the rollback of a failed transaction
+and the write lock taken by transactions.
+
+usage: python test/test_orm_batch.py
+"""
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import www.orm as orm
+from www.models import User, Blog
+
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "database", "schema.sql")
+
+changes = []
+
+
+def user(i, email=None):
+    return User(id=str(i), email=email or "test{}@example.com".format(i), password="1234567890", admin=False,
+                name="Test" + str(i), image="about:blank", created_at=i)
+
+
+async def check_save_all():
+    assert await User.save_all([user(i) for i in range(1, 6)]) == 5
+    assert await User.find_count() == 5
+    assert changes == [(User, frozenset("12345"))], changes
+    changes.clear()
+
+
+async def check_upsert_all():
+    renamed = user(2)
+    renamed.name = "Renamed"
+    assert await User.upsert_all([renamed, user(6)]) == 2
+    assert (await User.find("2")).name == "Renamed"
+    assert await User.find_count() == 6
+    assert changes == [(User, frozenset("26"))], changes
+    changes.clear()
+    # a conflict on email, another unique column, fails instead of deleting the user having that email
+    try:
+        await User.upsert_all([user(2, email="test1@example.com")])
+    except sqlite3.IntegrityError:
+        pass
+    else:
+        raise AssertionError("upsert_all replaced the row of another unique email")
+    assert await User.find("1") is not None
+    assert (await User.find("2")).email == "test2@example.com"
+    assert await User.find_count() == 6
+    assert not changes, changes
+
+
+async def check_rollback():
+    blog = Blog(user_id="1", title="t", summary="s", content="c", created_at=1)
+    try:
+        async with orm.transaction():
+            await blog.save_data()
+            await User.save_all([user(7), user(1)])
+    except sqlite3.IntegrityError:
+        pass
+    else:
+        raise AssertionError("duplicate primary key inserted")
+    assert await Blog.find(blog.id) is None
+    assert await User.find("7") is None
+    assert await Blog.find_count() == 0
+    assert not changes, changes
+    # the connection is usable after the rollback
+    async with orm.transaction():
+        await blog.save_data()
+        await user(7).save_data()
+    assert await Blog.find_count() == 1
+    assert changes == [(Blog, frozenset([blog.id])), (User, frozenset("7"))], changes
+    changes.clear()
+
+
+async def check_begin_immediate(path):
+    other = sqlite3.connect(path, timeout=0, isolation_level=None)
+    try:
+        async with orm.transaction():
+            user = await User.find("1")
+            # another process can't commit between the read and the write of the transaction
+            try:
+                other.execute("update users set name='Other' where id='1'")
+            except sqlite3.OperationalError:
+                pass
+            else:
+                raise AssertionError("the transaction doesn't hold the write lock")
+            user.name = "Renamed"
+            await user.update_data()
+    finally:
+        other.close()
+    assert (await User.find("1")).name == "Renamed"
+    changes.clear()
+
+
+async def check():
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "test.db")
+        conn = sqlite3.connect(path)
+        with open(SCHEMA, encoding="utf-8") as f:
+            conn.executescript(f.read())
+        conn.close()
+        orm.add_change_listener(lambda model, primary_keys: changes.append((model, primary_keys)))
+        await orm.create_pool(asyncio.get_event_loop(), path)
+        try:
+            await check_save_all()
+            await check_upsert_all()
+            await check_rollback()
+            await check_begin_immediate(path)
+        finally:
+            await orm.close_pool()
+    print("ok")
+
+
+if __name__ == '__main__':
+    asyncio.run(check())
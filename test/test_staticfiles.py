@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+check GET, HEAD and conditional GET of a static asset served from memory by www.staticfiles.
+
+usage: python test/test_staticfiles.py
+"""
+import asyncio
+import gzip
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from www.staticfiles import StaticAssets
+
+CSS = b"body { color: black; }\n" * 100
+
+
+async def check():
+    with tempfile.TemporaryDirectory() as root:
+        with open(os.path.join(root, "site.css"), "wb") as f:
+            f.write(CSS)
+        assets = StaticAssets(root)
+        app = web.Application()
+        app.router.add_route("GET", "/static/{path:.*}", assets.handle)
+        app.router.add_route("HEAD", "/static/{path:.*}", assets.handle)
+        url = assets.url("site.css")
+        async with TestClient(TestServer(app)) as client:
+            resp = await client.get(url, headers={"Accept-Encoding": "identity"})
+            assert resp.status == 200, resp.status
+            assert await resp.read() == CSS
+            assert resp.headers["Content-Type"].startswith("text/css")
+            assert "immutable" in resp.headers["Cache-Control"]
+            etag = resp.headers["ETag"]
+
+            resp = await client.get(url, headers={"Accept-Encoding": "gzip"}, auto_decompress=False)
+            assert resp.status == 200, resp.status
+            assert resp.headers["Content-Encoding"] == "gzip"
+            assert gzip.decompress(await resp.read()) == CSS
+            gzip_etag = resp.headers["ETag"]
+
+            resp = await client.head(url, headers={"Accept-Encoding": "identity"})
+            assert resp.status == 200, resp.status
+            assert resp.headers["Content-Length"] == str(len(CSS)), resp.headers.get("Content-Length")
+            assert resp.headers["ETag"] == etag
+            assert await resp.read() == b""
+
+            for tag in (etag, gzip_etag):
+                resp = await client.get(url, headers={"If-None-Match": tag, "Accept-Encoding": "gzip"})
+                assert resp.status == 304, resp.status
+                assert resp.headers["Vary"] == "Accept-Encoding"
+
+            resp = await client.get("/static/missing.css")
+            assert resp.status == 404, resp.status
+    print("ok")
+
+
+if __name__ == '__main__':
+    asyncio.run(check())
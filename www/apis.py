@@ -4,11 +4,21 @@ import math
 
 
 class Page:
-    def __init__(self, item_count, page_index=1, page_size=10):
+    # attributes serialized to json
+    __fields__ = ("item_count", "page_size", "page_count", "approximate", "page_index", "offset", "limit")
+
+    def __init__(self, item_count, page_index=1, page_size=10, approximate=False):
+        """
+        `approximate` marks an item count which may lag behind the table, e.g. a cached count,
+        the page just past the end of it is still served instead of falling back to the first page.
+        """
         self.item_count = item_count
         self.page_size = page_size
         self.page_count = int(math.ceil(item_count / page_size))
-        if item_count == 0 or page_index > self.page_count:
+        self.approximate = approximate
+        # with an approximate count one page of slack, so that the offset stays bounded
+        last_page = self.page_count + 1 if approximate else self.page_count
+        if item_count == 0 or page_index > last_page:
             self.page_index = 1
             self.offset = 0
             self.limit = 0
@@ -33,6 +43,29 @@ class Page:
     __repr__ = __str__
 
 
+class CursorPage:
+    """a page of keyset pagination, `next_cursor` is passed back as `cursor` to get the next page."""
+    __fields__ = ("cursor", "next_cursor", "page_size")
+
+    def __init__(self, cursor=None, next_cursor=None, page_size=10):
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+        self.page_size = page_size
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return bool(self.cursor)
+
+    def __str__(self):
+        return "cursor: {}, next cursor: {}, page size: {}".format(self.cursor, self.next_cursor, self.page_size)
+
+    __repr__ = __str__
+
+
 class APIError(Exception):
     """the base APIError which contains error(required), data(optional), message(optional)."""
 
@@ -2,33 +2,75 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
-import json
+import functools
+import hashlib
 import logging
+import re
 
-logging.basicConfig(level=logging.INFO)
+from www.config import configs
+from www.logs import setup_logging, request_logger, kv
+
+setup_logging(configs.logging.level, configs.logging.sample_rate)
 
 import os
+import shutil
+import signal
+import tempfile
 import time
 from datetime import datetime
+from email.utils import formatdate
 
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
-from www import orm
+from www import orm, metrics, offload, serializer
+from www.cache import LRUCache
 from www.coroweb import add_routes, add_static
+from www.models import Blog, Comment, User
+from www.server import Supervisor, create_socket
+from www.staticfiles import compress, parse_accept_encoding, brotli
 
 from www.handlers import COOKIE_NAME, cookie2user
 
+# responses served to anonymous readers: (path, query string, content version) => _CachedPage
+_page_cache = LRUCache(configs.page_cache.size, configs.page_cache.ttl)
+_content_version = 0
+_content_modified = time.time()
+
+
+def _on_content_change(model, primary_keys):
+    global _content_version, _content_modified
+    if model in (Blog, Comment, User):
+        _content_version += 1
+        _content_modified = time.time()
+        _page_cache.clear()
+
+
+orm.add_change_listener(_on_content_change)
+
 
 def init_jinja2(app, **kwargs):
+    """
+    with production=True templates are never stat'ed on render: all of them are compiled at startup,
+    through a bytecode cache in directory `bytecode_cache` (a temporary directory if None),
+    and are only reloaded by reload_templates().
+    """
     logging.info('init jinja2...')
+    production = kwargs.get("production", False)
     options = {
         "autoescape":            kwargs.get("autoescape", True),
         "block_start_string":    kwargs.get("block_start_string", "{%"),
         "block_end_string":      kwargs.get("block_end_string", "%}"),
         "variable_start_string": kwargs.get("variable_start_string", "{{"),
-        "auto_reload":           kwargs.get("auto_reload", True)
+        "auto_reload":           kwargs.get("auto_reload", not production)
     }
+    if production:
+        bytecode_cache = kwargs.get("bytecode_cache", None)
+        if bytecode_cache:
+            os.makedirs(bytecode_cache, exist_ok=True)
+        options["bytecode_cache"] = FileSystemBytecodeCache(bytecode_cache)
+        # keep every compiled template
+        options["cache_size"] = -1
     path = kwargs.get("path", None) or os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
     logging.info("set jinja2 template path: %s", path)
     env = Environment(loader=FileSystemLoader(path), **options)
@@ -36,12 +78,92 @@ def init_jinja2(app, **kwargs):
     if filters is not None:
         for name, filter in filters.items():
             env.filters[name] = filter
+    env.globals.update(kwargs.get("globals", None) or {})
     app["__templating__"] = env
+    app["__templates_path__"] = path
+    if production:
+        precompile_templates(env)
+
+
+def precompile_templates(env):
+    names = env.list_templates(extensions=("html",))
+    for name in names:
+        env.get_template(name)
+    logging.info("precompiled %d templates", len(names))
+
+
+def reload_templates(app):
+    """drop the compiled templates and compile them again, the bytecode cache skips unchanged ones"""
+    env = app["__templating__"]
+    env.cache.clear()
+    precompile_templates(env)
+
+
+def watch_templates(app, loop):
+    """reload templates on SIGUSR1, and on file changes if watchdog is installed"""
+    if hasattr(signal, "SIGUSR1"):
+        loop.add_signal_handler(signal.SIGUSR1, reload_templates, app)
+    try:
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+    except ImportError:
+        logging.info("watchdog not installed, templates are reloaded on SIGUSR1 only")
+        return None
+
+    class TemplateEventHandler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            if event.src_path.endswith(".html"):
+                logging.info("template changed: %s", event.src_path)
+                loop.call_soon_threadsafe(reload_templates, app)
+
+    observer = Observer()
+    observer.schedule(TemplateEventHandler(), app["__templates_path__"], recursive=True)
+    observer.daemon = True
+    observer.start()
+    return observer
+
+
+metrics.REGISTRY.register(metrics.Gauge(
+        "offload", "Calls running (pending) or waiting for a slot in the offload pools.", ("name",),
+        func=lambda: {(name,): value for name, value in offload.stats().items()}))
+metrics.REGISTRY.register(metrics.Gauge(
+        "db_pool", "Database connection pool state.", ("name",),
+        func=lambda: {(name,): value for name, value in orm.pool_stats().items()}))
+
+
+def get_route(request):
+    """the route pattern of the request as in @get/@post, which keeps the label values bounded"""
+    route = getattr(request.match_info.route.handler, "__route__", None)
+    if route is not None:
+        return route
+    if request.path.startswith("/static/"):
+        return "/static/"
+    return "unmatched"
+
+
+async def metrics_factory(app, handler):
+    async def record(request):
+        route = get_route(request)
+        metrics.requests_in_flight.inc(request.method, route)
+        start = time.perf_counter()
+        status = 500
+        try:
+            resp = await handler(request)
+            status = resp.status
+            return resp
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            metrics.requests_in_flight.dec(request.method, route)
+            metrics.observe_request(request.method, route, status, time.perf_counter() - start)
+
+    return record
 
 
 async def logger_factory(app, handler):
     async def logger(request):
-        logging.info("Request: %s %s", request.method, request.path)
+        request_logger.info("request", extra=kv(method=request.method, path=request.path))
         return await handler(request)
 
     return logger
@@ -49,13 +171,17 @@ async def logger_factory(app, handler):
 
 async def auth_factory(app, handler):
     async def auth(request):
-        logging.info("check user: %s %s", request.method, request.path)
         request.__user__ = None
+        if request.path.startswith("/static/"):
+            return await handler(request)
+        # the session, page and count caches follow the writes of the other workers
+        orm.sync_changes()
+        request_logger.debug("check user", extra=kv(method=request.method, path=request.path))
         cookie = request.cookies.get(COOKIE_NAME)
         if cookie:
             user = await cookie2user(cookie)
             if user:
-                logging.info("set current user: %s", user.email)
+                request_logger.debug("set current user", extra=kv(email=user.email))
                 request.__user__ = user
         if request.path.startswith("/manage/") and (request.__user__ is None or not request.__user__.admin):
             return web.HTTPFound("/login")
@@ -64,24 +190,171 @@ async def auth_factory(app, handler):
     return auth
 
 
+# (strong ETag, encoding) => compressed body, so that cached pages are compressed once
+_compressed_cache = LRUCache(configs.compression.cache_size)
+
+_RE_ETAG_ENCODING = re.compile(r'-(?:gzip|br)"$')
+
+
+def strip_etag_encoding(etag):
+    """the ETag of the uncompressed representation of `etag`"""
+    return _RE_ETAG_ENCODING.sub('"', etag)
+
+
+def encode_etag(etag, encoding):
+    return '{}-{}"'.format(etag[:-1], encoding)
+
+
+class _CachedPage:
+    def __init__(self, body, content_type, modified):
+        self.body = body
+        self.content_type = content_type
+        self.etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        self.modified = int(modified)
+
+    def is_fresh(self, request):
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return if_none_match.strip() == "*" or \
+                   self.etag in (strip_etag_encoding(tag.strip()) for tag in if_none_match.split(","))
+        if_modified_since = request.if_modified_since
+        return if_modified_since is not None and if_modified_since.timestamp() >= self.modified
+
+    def response(self, request):
+        if self.is_fresh(request):
+            resp = web.Response(status=304)
+        else:
+            resp = web.Response(body=self.body)
+            resp.content_type = self.content_type
+        resp.headers["ETag"] = self.etag
+        resp.headers["Last-Modified"] = formatdate(self.modified, usegmt=True)
+        resp.headers["Cache-Control"] = "public, no-cache"
+        resp.headers["Vary"] = "Cookie"
+        return resp
+
+
+async def cache_factory(app, handler):
+    async def cache(request):
+        if request.method != "GET" or request.__user__ is not None or \
+                request.path.startswith(("/static/", "/manage", "/metrics")):
+            return await handler(request)
+        key = (request.path, request.query_string, _content_version)
+        page = _page_cache.get(key)
+        if page is None:
+            modified = _content_modified
+            resp = await handler(request)
+            if not isinstance(resp, web.Response) or resp.status != 200 or resp.cookies or \
+                    not isinstance(resp.body, bytes) or key[2] != _content_version:
+                return resp
+            page = _CachedPage(resp.body, resp.headers.get("Content-Type"), modified)
+            _page_cache.set(key, page)
+        return page.response(request)
+
+    return cache
+
+
+async def compression_factory(app, handler):
+    """
+    compress html and json responses of at least min_size bytes with brotli or gzip.
+    compressed bodies of responses with a strong ETag are kept in _compressed_cache,
+    and while the process uses more than max_cpu of a core only those are served compressed.
+    """
+    options = configs.compression
+    types = frozenset(options.types)
+    encodings = ("br", "gzip") if brotli is not None else ("gzip",)
+
+    async def compress_response(request):
+        resp = await handler(request)
+        if not isinstance(resp, web.Response) or "Content-Encoding" in resp.headers:
+            return resp
+        accepted = parse_accept_encoding(request.headers.get("Accept-Encoding"))
+        encoding = next((encoding for encoding in encodings if encoding in accepted), None)
+        etag = resp.headers.get("ETag")
+        if resp.status == 304:
+            # answer with the ETag the client has, which is the compressed one if it was sent compressed
+            if encoding is not None and etag is not None and \
+                    encode_etag(etag, encoding) in request.headers.get("If-None-Match", ""):
+                resp.headers["ETag"] = encode_etag(etag, encoding)
+                resp.headers["Vary"] = resp.headers["Vary"] + ", Accept-Encoding" if "Vary" in resp.headers \
+                    else "Accept-Encoding"
+            return resp
+        body = resp.body
+        if resp.status != 200 or not isinstance(body, bytes) or len(body) < options.min_size or \
+                resp.content_type not in types:
+            return resp
+        vary = resp.headers.get("Vary")
+        resp.headers["Vary"] = vary + ", Accept-Encoding" if vary else "Accept-Encoding"
+        if encoding is None:
+            return resp
+        key = (etag, encoding) if etag is not None and not etag.startswith("W/") else None
+        compressed = _compressed_cache.get(key) if key is not None else None
+        if compressed is None:
+            if metrics.cpu_usage() > options.max_cpu:
+                return resp
+            compressed = compress(body, encoding, options.level)
+            if key is not None:
+                _compressed_cache.set(key, compressed)
+        if len(compressed) >= len(body):
+            return resp
+        resp.body = compressed
+        resp.headers["Content-Encoding"] = encoding
+        if etag is not None:
+            resp.headers["ETag"] = encode_etag(etag, encoding)
+        return resp
+
+    return compress_response
+
+
 async def data_factory(app, handler):
     async def parse_data(request):
         if request.method == "POST":
             if request.content_type.startswith("application/json"):
                 request.__data__ = await request.json()
-                logging.info("request json: {}".format(request.__data__))
+                request_logger.debug("request json", extra=kv(data=request.__data__))
             elif request.content_type.startswith("application/x-www-form-urlencoded"):
                 request.__data__ = await request.post()
-                logging.info("request form: {}".format(request.__data__))
+                request_logger.debug("request form", extra=kv(data=request.__data__))
         return await handler(request)
 
     return parse_data
 
 
+async def stream_json(request, obj):
+    """send large results in chunks, without building the whole body"""
+    resp = web.StreamResponse()
+    resp.content_type = "application/json;charset=utf-8"
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+    for chunk in serializer.iterencode(obj):
+        await resp.write(chunk)
+    await resp.write_eof()
+    return resp
+
+
+# template name => seconds of its last render
+_render_times = {}
+
+
+def _render(name, template, context):
+    start = time.perf_counter()
+    ret = template.render(**context).encode()
+    _render_times[name] = time.perf_counter() - start
+    return ret
+
+
+async def render_template(app, name, context):
+    """render on the offload threads the templates whose last render took more than offload.template_min_time"""
+    template = app["__templating__"].get_template(name)
+    if _render_times.get(name, 0) > configs.offload.template_min_time:
+        return await offload.in_thread(_render, name, template, context)
+    return _render(name, template, context)
+
+
 async def response_factory(app, handler):
     async def response(request):
-        logging.info("Response handler...")
         resp = await handler(request)
+        if isinstance(resp, orm.SlotModel):
+            resp = serializer.default(resp)
         if isinstance(resp, web.StreamResponse):
             pass
         elif isinstance(resp, bytes):
@@ -95,12 +368,16 @@ async def response_factory(app, handler):
         elif isinstance(resp, dict):
             template = resp.get("__template__")
             if template is None:
-                resp = web.Response(
-                        body=json.dumps(resp, ensure_ascii=False, default=lambda obj: obj.__dict__).encode())
+                if serializer.should_stream(resp):
+                    return await stream_json(request, resp)
+                if serializer.size_hint(resp) >= configs.offload.json_min_items:
+                    resp = web.Response(body=await offload.in_thread(serializer.dumps, resp))
+                else:
+                    resp = web.Response(body=serializer.dumps(resp))
                 resp.content_type = "application/json;charset=utf-8"
             else:
                 resp["__user__"] = request.__user__
-                resp = web.Response(body=app["__templating__"].get_template(template).render(**resp).encode())
+                resp = web.Response(body=await render_template(app, template, resp))
                 resp.content_type = "text/html;charset=utf-8"
         elif isinstance(resp, int) and 100 <= resp < 600:
             resp = web.Response(status=resp)
@@ -128,20 +405,75 @@ def datetime_filter(t):
         return datetime.fromtimestamp(t).isoformat()
 
 
-async def init():
-    await orm.create_pool(loop, "../database/sqlite.db")
-    app = web.Application(loop=loop, middlewares=[
-        logger_factory, auth_factory, data_factory, response_factory
+def create_app():
+    """the application with its routes, templates and static assets, which doesn't depend on an event loop"""
+    app = web.Application(middlewares=[
+        metrics_factory, logger_factory, auth_factory, compression_factory, cache_factory, data_factory,
+        response_factory
     ])
-    init_jinja2(app, filters={"datetime": datetime_filter})
+    add_static(app, **configs.static)
+    init_jinja2(app, filters={"datetime": datetime_filter}, globals={"static_url": app["__static__"].url},
+                production=configs.templates.production, bytecode_cache=configs.templates.bytecode_cache)
     add_routes(app, "handlers")
-    add_static(app)
-    srv = await loop.create_server(app.make_handler(), "127.0.0.1", 9000)
-    logging.info("server started at http://127.0.0.1:9000")
-    return srv
+    return app
 
 
-if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(init())
+async def init_worker(app, loop):
+    """set up what belongs to the serving process: the database connections, signal handlers and tasks"""
+    orm.SLOW_QUERY_THRESHOLD = configs.db_slow_query
+    await orm.create_pool(loop, configs.db, configs.db_backend)
+    offload.setup(configs.offload.processes, configs.offload.threads, configs.offload.max_pending)
+    if configs.templates.production:
+        watch_templates(app, loop)
+    elif hasattr(signal, "SIGUSR1"):
+        # forwarded by the master of several workers
+        loop.add_signal_handler(signal.SIGUSR1, reload_templates, app)
+    loop.create_task(metrics.monitor_event_loop())
+
+
+def serve(app, sock, ready=None):
+    """serve `app` on the listening socket `sock` until SIGTERM or SIGINT, then finish the open requests"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(init_worker(app, loop))
+    handler = app.make_handler(loop=loop)
+    srv = loop.run_until_complete(loop.create_server(handler, sock=sock))
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, loop.stop)
+    logging.info("worker %d serving", os.getpid())
+    if ready is not None:
+        ready()
     loop.run_forever()
+
+    srv.close()
+    loop.run_until_complete(srv.wait_closed())
+    loop.run_until_complete(app.shutdown())
+    loop.run_until_complete(handler.shutdown(configs.server.shutdown_timeout))
+    loop.run_until_complete(app.cleanup())
+    loop.run_until_complete(orm.close_pool())
+    offload.shutdown()
+    loop.close()
+
+
+def main():
+    options = configs.server
+    app = create_app()
+    if options.workers == 1:
+        sock = create_socket(options.host, options.port, options.unix, unix_mode=options.unix_mode)
+        logging.info("server started at %s", options.unix or "http://{}:{}".format(options.host, options.port))
+        serve(app, sock)
+        return
+    # the workers notify each other of the changes which invalidate their caches, and expose each other's metrics
+    orm.share_changes()
+    metrics_dir = tempfile.mkdtemp(prefix="awesome-metrics-")
+    metrics.share(metrics_dir)
+    try:
+        Supervisor(functools.partial(serve, app), options.workers, options.host, options.port, options.unix,
+                   reuse_port=options.reuse_port, shutdown_timeout=options.shutdown_timeout,
+                   unix_mode=options.unix_mode).run()
+    finally:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+migrate the comments of an existing database: add the html_content column if it is missing,
+then fill it for the comments saved before it existed.
+
+usage: python -m www.backfill [--all]
+
+only the comments whose html_content is empty are rendered, unless --all is given,
+e.g. after a change of rendering.text2html. once the column exists it can run while the server is serving.
+"""
+import asyncio
+import logging
+import sys
+
+from www import orm
+from www.config import configs
+from www.models import Comment
+from www.rendering import text2html
+
+BATCH_SIZE = 500
+
+_UPDATE = "update `{}` set `html_content`=? where `{}`=?".format(Comment.__table__, Comment.__primary_key__)
+
+
+async def add_html_column():
+    """add the html_content column to the comments table if it doesn't have it, returns whether it was added"""
+    columns = [row[1] for row in await orm.select("pragma table_info(`{}`)".format(Comment.__table__), [])]
+    if "html_content" in columns:
+        return False
+    await orm.execute("alter table `{}` add column `html_content` text not null default ''".format(Comment.__table__),
+                      [])
+    logging.info("added column %s.html_content", Comment.__table__)
+    return True
+
+
+async def backfill_comments(render_all=False, batch=BATCH_SIZE):
+    """render the html of the comments, `batch` comments per transaction, returns the number of comments updated"""
+    where, args = (None, None) if render_all else ("html_content=?", [""])
+    updated = 0
+    updates = []
+    async for comment in Comment.iter_all(where, args, batch=batch):
+        updates.append((text2html(comment.content), comment.id))
+        if len(updates) >= batch:
+            updated += await orm.execute_many(_UPDATE, updates, batch)
+            logging.info("backfilled %d comments", updated)
+            updates = []
+    if updates:
+        updated += await orm.execute_many(_UPDATE, updates, batch)
+    return updated
+
+
+async def main(render_all=False):
+    await orm.create_pool(asyncio.get_event_loop(), configs.db, configs.db_backend)
+    try:
+        await add_html_column()
+        updated = await backfill_comments(render_all)
+    finally:
+        await orm.close_pool()
+    logging.info("done, %d comments updated", updated)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main("--all" in sys.argv[1:]))
@@ -2,9 +2,95 @@
 # -*- coding: utf-8 -*-
 
 configs = {
-    'debug':   True,
-    'db':      "../database/sqlite.db",
-    'session': {
-        'secret': 'Awesome'
+    'debug':         True,
+    'db':            "../database/sqlite.db",
+    # "sqlite" (stdlib sqlite3) or "odbc" (aioodbc and the SQLite3 ODBC driver)
+    'db_backend':    "sqlite",
+    # seconds above which sql statements are logged as slow queries
+    'db_slow_query': 0.1,
+    'session':       {
+        'secret':     'Awesome',
+        # verified users cached by session cookie
+        'cache_size': 1024,
+        'cache_ttl':  300
+    },
+    'markdown':      {
+        # rendered html cached in memory by content hash
+        'cache_size':       256,
+        # also store rendered html in table `rendered_markdown`
+        'persist':          False,
+        # html of top-level blocks (paragraphs, lists, ...), only changed blocks of an edited post are rendered
+        'block_cache_size': 8192
+    },
+    'page_cache':    {
+        # pages and api results served to anonymous readers, the ttl bounds the age of relative times
+        'size': 512,
+        'ttl':  60
+    },
+    'metrics':       {
+        # scrapers sending "Authorization: Bearer <token>" are allowed from anywhere, None for no token
+        'token':           None,
+        # client addresses allowed to scrape /metrics without the token
+        'allow':           ["127.0.0.1", "::1"],
+        # addresses of the reverse proxies ("unix" for the unix socket), the client address of their requests
+        # is the last one of X-Forwarded-For. requests forwarded by other proxies need the token
+        'trusted_proxies': ["unix"]
+    },
+    'logging':       {
+        'level':       "INFO",
+        # fraction of the request and sql logs below WARNING which are written
+        'sample_rate': 1.0
+    },
+    'templates':     {
+        # compile all templates at startup and don't check them for changes on every render,
+        # they are reloaded on SIGUSR1 or, with watchdog installed, when a template file changes
+        'production':     False,
+        # directory of the jinja2 bytecode cache in production mode, None for a temporary directory
+        'bytecode_cache': None
+    },
+    'static':        {
+        # files up to this size are kept in memory with their gzip/brotli variants
+        'max_size':       1048576,
+        # seconds to cache assets requested through static_url(), which adds a content version
+        'max_age':        31536000,
+        # seconds to cache assets requested without the version, before revalidating by ETag
+        'revalidate_age': 3600
+    },
+    'compression':   {
+        # html and json responses from this size are compressed with brotli (if installed) or gzip
+        'min_size':   1024,
+        'level':      6,
+        'types':      ["text/html", "text/plain", "application/json"],
+        # process cpu usage (1.0 is a whole core) above which only already compressed bodies are sent compressed
+        'max_cpu':    0.8,
+        # compressed bodies of cached pages
+        'cache_size': 1024
+    },
+    'server':        {
+        'host':             "127.0.0.1",
+        'port':             9000,
+        # path of a unix socket to listen on instead of host:port, e.g. behind a reverse proxy
+        'unix':             None,
+        # permissions of the unix socket file, owner and group (e.g. the reverse proxy's) can connect
+        'unix_mode':        0o660,
+        # worker processes forked by a master process, None for one per cpu, 1 serves in a single process
+        'workers':          1,
+        # with several workers, every worker listens on its own socket with SO_REUSEPORT (linux, tcp only)
+        'reuse_port':       False,
+        # seconds given to the open requests when a worker stops
+        'shutdown_timeout': 10
+    },
+    'offload':       {
+        # processes rendering markdown, and threads rendering templates and json, per worker, 0 runs them inline
+        'processes':         2,
+        'threads':           4,
+        # calls running or queued in each pool, more callers wait in the event loop
+        'max_pending':       32,
+        # markdown from this length is rendered in the process pool
+        'markdown_min_size': 20000,
+        # json results with this many items in their lists are encoded in the thread pool
+        'json_min_items':    200,
+        # templates whose last render took longer (seconds) are rendered in the thread pool
+        'template_min_time': 0.005
     }
 }
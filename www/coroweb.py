@@ -10,6 +10,8 @@ from urllib.parse import parse_qs
 from aiohttp import web
 
 from www.apis import APIError
+from www.logs import request_logger, kv
+from www.staticfiles import StaticAssets
 
 
 def get(path):
@@ -84,6 +86,8 @@ class RequestHandler:
     def __init__(self, app, func):
         self._app = app
         self._func = func
+        self.__method__ = getattr(func, "__method__", None)
+        self.__route__ = getattr(func, "__route__", None)
         self._has_request_arg = has_request_arg(func)
         self._has_var_kwarg = has_var_kwarg(func)
         self._has_named_kwargs = has_named_kwargs(func)
@@ -130,16 +134,20 @@ class RequestHandler:
             for name in self._required_kwargs:
                 if name not in kwargs:
                     return web.HTTPBadRequest(text="Missing argument: {}".format(name))
-        logging.info("call with args: {}" + str(kwargs))
+        request_logger.debug("call handler", extra=kv(handler=self._func.__name__, args=kwargs))
         try:
             return await self._func(**kwargs)
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
 
 
-def add_static(app):
+def add_static(app, **kwargs):
+    """serve /static/ from memory, kwargs are passed to StaticAssets"""
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
-    app.router.add_static("/static/", path)
+    assets = StaticAssets(path, **kwargs)
+    app["__static__"] = assets
+    app.router.add_route("GET", "/static/{path:.*}", assets.handle)
+    app.router.add_route("HEAD", "/static/{path:.*}", assets.handle)
     logging.info("add static {} => {}".format("/static/", path))
 
 
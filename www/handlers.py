@@ -1,24 +1,42 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import hashlib
-import html
-import json
+import hmac
 import logging
 import re
 import time
 
 from aiohttp import web
 
-from www import markdown2
-from www.apis import APIValueError, APIError, APIPermissionError, Page, APIResourceNotFoundError
+from www import metrics, serializer
+from www.apis import APIValueError, APIError, APIPermissionError, Page, APIResourceNotFoundError, CursorPage
+from www.cache import LRUCache
 from www.config import configs
 from www.coroweb import get, post
 from www.models import Blog, User, next_id, Comment
+from www.orm import add_change_listener, session, transaction, get_stats, reset_stats
+from www.rendering import markdown2html, cache_markdown, uncache_markdown, preview_markdown, text2html
 
 COOKIE_NAME = "awesome+session"
 
 _COOKIE_KEY = configs.session.secret
 
+# session cookie => verified user
+_session_cache = LRUCache(configs.session.cache_size, configs.session.cache_ttl)
+
+
+def _invalidate_sessions(model, primary_keys):
+    if model is User:
+        if primary_keys is None:
+            # users changed by another worker
+            _session_cache.clear()
+        else:
+            _session_cache.remove_if(lambda cookie, user: user.id in primary_keys)
+
+
+add_change_listener(_invalidate_sessions)
+metrics.add_snapshot("sql", get_stats)
+
 
 def check_admin(request):
     if request.__user__ is None or not request.__user__.admin:
@@ -32,15 +50,25 @@ def get_page_index(page: str):
         return 1
 
 
+async def get_cursor_page(model, cursor: str, where=None, args=None, page_size=10):
+    try:
+        items, next_cursor = await model.find_page(where, args, cursor=cursor or None, limit=page_size)
+    except ValueError:
+        raise APIValueError("cursor", "invalid cursor")
+    return items, CursorPage(cursor, next_cursor, page_size)
+
+
 def user2cookie(user: User, max_age):
     expires = str(int(time.time() + max_age))
     s = "-".join([user.id, user.password, expires, _COOKIE_KEY])
     return "-".join([user.id, expires, hashlib.sha1(s.encode()).hexdigest()])
 
 
-def text2html(text: str):
-    return "\n".join("<p>{}</p>".format(html.escape(s))
-                     for s in text.split("\n") if s.strip())
+async def attach_users(items):
+    """load the authors of blogs or comments in one query and set them to `item.user`."""
+    users = await User.attach(items, "user_id", "user")
+    for user in users.values():
+        user.shadow_password()
 
 
 async def cookie2user(cookie: str):
@@ -53,6 +81,9 @@ async def cookie2user(cookie: str):
         uid, expires, sha1 = l
         if int(expires) < time.time():
             return None
+        user = _session_cache.get(cookie)
+        if user is not None:
+            return user
         user = await User.find(uid)
         if user is None:
             return None
@@ -61,6 +92,7 @@ async def cookie2user(cookie: str):
             logging.info("invalid sha1")
             return None
         user.password = "********"
+        _session_cache.set(cookie, user)
         return user
     except Exception as e:
         logging.exception(e)
@@ -70,8 +102,8 @@ async def cookie2user(cookie: str):
 @get("/")
 async def index(*, page="1"):
     page_index = get_page_index(page)
-    num = await Blog.find_number("count(id)")
-    page = Page(num, page_index)
+    num = await Blog.find_count()
+    page = Page(num, page_index, approximate=True)
     blogs = [] if num == 0 else await Blog.find_all(orderBy="created_at desc", limit=(page.offset, page.limit))
     return {
         "__template__": "blogs.html",
@@ -83,14 +115,13 @@ async def index(*, page="1"):
 @get("/blog/{id}")
 async def get_blog(id):
     blog = await Blog.find(id)
-    blog.user = await User.find(blog.user_id)
-    blog.user.shadow_password()
     comments = await Comment.find_all("blog_id=?", [id], orderBy="created_at desc")
     for comment in comments:
-        comment.html_content = text2html(comment.content)
-        comment.user = await User.find(comment.user_id)
-        comment.user.shadow_password()
-    blog.html_content = markdown2.markdown(blog.content)
+        if not comment.html_content:
+            # saved before html_content existed and not backfilled yet, see www/backfill.py
+            comment.html_content = text2html(comment.content)
+    await attach_users([blog] + comments)
+    blog.html_content = await markdown2html(blog.content)
     return {
         "__template__": "blog.html",
         "blog":         blog,
@@ -133,7 +164,7 @@ async def authenticate(*, email, password):
     response.set_cookie(COOKIE_NAME, user2cookie(user, 86400))
     user.password = "********"
     response.content_type = "application/json"
-    response.body = json.dumps(user, ensure_ascii=False).encode()
+    response.body = serializer.dumps(user)
     return response
 
 
@@ -194,17 +225,22 @@ def manage_users(*, page="1"):
 
 
 @get("/api/comments")
-async def api_comments(*, page="1"):
+async def api_comments(*, page="1", cursor=None):
+    if cursor is not None:
+        comments, p = await get_cursor_page(Comment, cursor)
+        await attach_users(comments)
+        return {
+            "page":     p,
+            "comments": comments
+        }
     page_index = get_page_index(page)
-    num = await Comment.find_number("count(id)")
-    p = Page(num, page_index)
+    num = await Comment.find_count()
+    p = Page(num, page_index, approximate=True)
     if num == 0:
         comments = ()
     else:
         comments = await Comment.find_all(orderBy="created_at desc", limit=(p.offset, p.limit))
-        for comment in comments:
-            comment.user = await User.find(comment.user_id)
-            comment.user.shadow_password()
+        await attach_users(comments)
     return {
         "page":     p,
         "comments": comments
@@ -218,11 +254,13 @@ async def api_create_comments(id, request, *, content):
         raise APIPermissionError("Please signin first.")
     if not content or not content.strip():
         raise APIValueError("content")
-    blog = await Blog.find(id)
-    if blog is None:
-        raise APIResourceNotFoundError("Blog")
-    comment = Comment(blog_id=blog.id, user_id=user.id, content=content.strip())
-    await comment.save_data()
+    async with session():
+        blog = await Blog.find(id)
+        if blog is None:
+            raise APIResourceNotFoundError("Blog")
+        content = content.strip()
+        comment = Comment(blog_id=blog.id, user_id=user.id, content=content, html_content=text2html(content))
+        await comment.save_data()
     return comment
 
 
@@ -237,10 +275,18 @@ async def api_delete_comments(id, request):
 
 
 @get("/api/users")
-async def api_get_users(*, page="1"):
+async def api_get_users(*, page="1", cursor=None):
+    if cursor is not None:
+        users, p = await get_cursor_page(User, cursor)
+        for user in users:
+            user.shadow_password()
+        return {
+            "page":  p,
+            "users": users
+        }
     page_index = get_page_index(page)
-    num = await User.find_number("count(id)")
-    p = Page(num, page_index)
+    num = await User.find_count()
+    p = Page(num, page_index, approximate=True)
     if num == 0:
         users = ()
     else:
@@ -283,20 +329,21 @@ async def api_register_user(*, email, name, password):
     response.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.password = '********'
     response.content_type = 'application/json'
-    response.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    response.body = serializer.dumps(user)
     return response
 
 
 @get("/api/blogs")
-async def api_blogs(*, page="1"):
+async def api_blogs(*, page="1", cursor=None):
+    if cursor is not None:
+        blogs, page = await get_cursor_page(Blog, cursor)
+        await attach_users(blogs)
+        return {"page": page, "blogs": blogs}
     page_index = get_page_index(page)
-    page_count = await Blog.find_number("count(id)")
-    page = Page(page_count, page_index)
+    page_count = await Blog.find_count()
+    page = Page(page_count, page_index, approximate=True)
     blogs = await Blog.find_all(orderBy="created_at desc", limit=(page.offset, page.limit)) if page_count != 0 else []
-    for blog in blogs:
-        user = await User.find(blog.user_id)
-        user.password = '********'
-        setattr(blog, "user", user)
+    await attach_users(blogs)
     return {"page": page, "blogs": blogs}
 
 
@@ -315,7 +362,10 @@ async def api_create_blog(request, *, title, summary, content):
     if not content or not content.strip():
         raise APIValueError('content', 'content cannot be empty.')
     blog = Blog(user_id=request.__user__.id, title=title.strip(), summary=summary.strip(), content=content.strip())
-    await blog.save_data()
+    async with transaction():
+        await blog.save_data()
+    # after the commit: the html is keyed by content, and rendering shouldn't hold the writer
+    await cache_markdown(blog.content)
     return blog
 
 
@@ -328,14 +378,67 @@ async def api_update_blog(id, request, *, title, summary, content):
         raise APIValueError("summary", "summary cannot be empty.")
     if not content or not content.strip():
         raise APIValueError("content", "content cannot be empty.")
-    blog = await Blog.find(id)
-    blog.name = title.strip()
-    blog.summary = summary.strip()
-    blog.content = content.strip()
-    await blog.update_data()
+    async with transaction():
+        blog = await Blog.find(id)
+        old_content = blog.content
+        blog.name = title.strip()
+        blog.summary = summary.strip()
+        blog.content = content.strip()
+        await blog.update_data()
+    if blog.content != old_content:
+        await uncache_markdown(old_content)
+        await cache_markdown(blog.content)
     return blog
 
 
+@post("/api/markdown/preview")
+async def api_preview_markdown(request, *, content):
+    check_admin(request)
+    return {"html": await preview_markdown(content)}
+
+
+@get("/api/stats/sql")
+async def api_sql_stats(request):
+    """the stats of this worker, and those of every worker by pid as of their last metrics snapshot"""
+    check_admin(request)
+    return {"statements": get_stats(), "workers": metrics.worker_snapshots("sql")}
+
+
+@post("/api/stats/sql/reset")
+async def api_reset_sql_stats(request):
+    """reset the stats of the worker answering"""
+    check_admin(request)
+    reset_stats()
+    return {}
+
+
+def metrics_allowed(request):
+    """if the request has the metrics token, or comes from an allowed client address (see configs.metrics)"""
+    options = configs.metrics
+    if options.token and hmac.compare_digest(request.headers.get("Authorization", ""), "Bearer " + options.token):
+        return True
+    # requests on the unix socket have no remote address
+    peer = request.remote or "unix"
+    forwarded = request.headers.get("X-Forwarded-For")
+    if peer in options.trusted_proxies:
+        if not forwarded:
+            return False
+        client = forwarded.split(",")[-1].strip()
+    elif forwarded or "Forwarded" in request.headers:
+        # the peer is a proxy which isn't trusted, its address isn't the client's
+        return False
+    else:
+        client = peer
+    return client in options.allow
+
+
+@get("/metrics")
+async def api_metrics(request):
+    if not metrics_allowed(request):
+        raise web.HTTPForbidden()
+    return web.Response(body=metrics.render().encode(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
 @post("/api/blogs/{id}/delete")
 async def api_delete_blog(request, *, id):
     check_admin(request)
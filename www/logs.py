@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+logging set up: records are handed to a queue on the calling thread and formatted and written
+by a background listener thread, so the event loop never waits for log i/o.
+
+the verbose per-request and per-statement logs go to the `awesome.request` and `awesome.sql` loggers,
+whose records below WARNING are sampled. structured fields are passed with `extra=kv(...)`:
+
+    request_logger.info("request", extra=kv(method=request.method, path=request.path))
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+
+request_logger = logging.getLogger("awesome.request")
+sql_logger = logging.getLogger("awesome.sql")
+
+_listener = None
+# the arguments of the last setup_logging()
+_settings = {}
+
+
+def kv(**fields):
+    """the `extra` of a record with structured key/value fields"""
+    return {"fields": fields}
+
+
+class KeyValueFormatter(logging.Formatter):
+    """appends the key/value fields of a record to its message"""
+
+    def format(self, record):
+        s = super(KeyValueFormatter, self).format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            s = s + " " + " ".join("{}={!r}".format(k, v) for k, v in fields.items())
+        return s
+
+
+class SamplingFilter(logging.Filter):
+    """let through a `rate` fraction of the records below WARNING, and all others"""
+
+    def __init__(self, rate):
+        super(SamplingFilter, self).__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    a queue handler which leaves the formatting to the listener thread, unlike QueueHandler.prepare.
+    only exception tracebacks are rendered on the calling thread since they refer to live frames.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(level="INFO", sample_rate=1.0, fmt="%(asctime)s %(levelname)s %(name)s: %(message)s"):
+    """route all logging through a queue to a background writer, replacing the handlers of the root logger"""
+    global _listener
+    _settings.update(level=level, sample_rate=sample_rate, fmt=fmt)
+    if _listener is not None:
+        _listener.stop()
+    handler = logging.StreamHandler()
+    handler.setFormatter(KeyValueFormatter(fmt))
+    q = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(q, handler, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    root.addHandler(DeferredQueueHandler(q))
+    root.setLevel(level)
+    for logger in (request_logger, sql_logger):
+        for f in logger.filters[:]:
+            logger.removeFilter(f)
+        if sample_rate < 1:
+            logger.addFilter(SamplingFilter(sample_rate))
+
+
+def restart_logging():
+    """set up logging again as it was, e.g. in a forked process which doesn't have the writer thread"""
+    setup_logging(**_settings)
+
+
+def stop_logging():
+    """flush the queued records and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
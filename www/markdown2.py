@@ -92,6 +92,9 @@ __author__ = "Trent Mick"
 import sys
 import re
 import logging
+import threading
+from collections import OrderedDict
+from itertools import islice
 
 try:
     from hashlib import md5
@@ -133,6 +136,11 @@ log = logging.getLogger("markdown")
 
 DEFAULT_TAB_WIDTH = 4
 
+# The number of highlighted code blocks and of lexers kept by the
+# "fenced-code-blocks" and "code-color" extras.
+PYGMENTS_CACHE_SIZE = 512
+PYGMENTS_LEXER_CACHE_SIZE = 64
+
 SECRET_SALT = bytes(randint(0, 1000000))
 
 
@@ -260,7 +268,16 @@ class Markdown(object):
         # essential. Link and image substitutions need to happen before
         # _EscapeSpecialChars(), so that any *'s or _'s in the <a>
         # and <img> tags get encoded.
+        text = self._prepare_document(text)
+
+        text = self._run_block_gamut(text)
 
+        return self._finish_document(text)
+
+    def _prepare_document(self, text):
+        """The document-wide passes run before the block gamut: hashing of
+        HTML blocks, stripping of link and footnote definitions, etc.
+        """
         # Clear the global hashes. If we don't clear these, you get conflicts
         # from other articles when generating a page which contains more than
         # one article (e.g. an index page that shows the N most recent
@@ -327,9 +344,10 @@ class Markdown(object):
             #   [^4]: this "looks like a link defn"
             text = self._strip_footnote_definitions(text)
         text = self._strip_link_definitions(text)
+        return text
 
-        text = self._run_block_gamut(text)
-
+    def _finish_document(self, text):
+        """The document-wide passes run after the block gamut."""
         if "footnotes" in self.extras:
             text = self._add_footnotes(text)
 
@@ -352,6 +370,111 @@ class Markdown(object):
             rv.metadata = self.metadata
         return rv
 
+    # A line which may make a header: '#'s, or a setext underline.
+    _header_line_re = re.compile(r'^[ \t>]*(\#|[=-]+[ \t]*$)', re.M)
+
+    def convert_incremental(self, text, cache):
+        """Convert the given text like `convert()`, reusing the HTML of the
+        top-level blocks which were already converted.
+
+        `cache` is a `BlockCache` (or any object with `get(key)` and
+        `set(key, value)`), it may be shared between `Markdown` instances.
+        The document-wide passes (HTML block hashing, link and footnote
+        definitions, footnotes, unescaping) are still run on the whole text,
+        only the block gamut is run per block. The HTML of a block is keyed
+        by a hash of its source, the options and, if it may contain a link,
+        the link definitions of the document. Blocks with footnote
+        references, and headers when "header-ids" is on, number things
+        across the document and are always converted.
+        """
+        if self.safe_mode:
+            # the hashed HTML spans are only valid in their document
+            return self.convert(text)
+        text = self._prepare_document(text)
+
+        options = repr((sorted(self.extras.items()), self.tab_width,
+                        self.empty_element_suffix, self.link_patterns))
+        links = None
+        # hash => text of the code spans and blocks hidden in the HTML
+        self._escapes_from_hash = dict(
+            (hashed, text) for text, hashed in self._escape_table.items())
+        html = []
+        # an empty document still makes an empty paragraph
+        for block in self._split_blocks(text) or [""]:
+            if (("footnotes" in self.extras and "[^" in block)
+                    or ("header-ids" in self.extras
+                        and self._header_line_re.search(block))):
+                key = None
+            else:
+                if "[" in block:
+                    if links is None:
+                        links = repr((sorted(self.urls.items()),
+                                      sorted(self.titles.items())))
+                    key = options + links + block
+                else:
+                    key = options + block
+                key = md5(key.encode("utf-8")).hexdigest()
+                cached = cache.get(key)
+                if cached is not None:
+                    converted, escapes = cached
+                    for text, hashed in escapes:
+                        self._escape_table.setdefault(text, hashed)
+                    html.append(converted)
+                    continue
+            converted = self._convert_block(block)
+            if key is not None:
+                cache.set(key, (converted, self._block_escapes(converted)))
+            html.append(converted)
+
+        return self._finish_document("\n\n".join(h for h in html if h))
+
+    def _convert_block(self, block):
+        self.list_level = 0
+        n = len(self._escape_table)
+        ret = self._run_block_gamut(block + "\n\n")
+        for text, hashed in islice(self._escape_table.items(), n, None):
+            self._escapes_from_hash[hashed] = text
+        return ret
+
+    _hash_re = re.compile(r'md5-[0-9a-f]{32}')
+
+    def _block_escapes(self, html):
+        """The escape table entries which the HTML of a block needs for
+        `_unescape_special_chars()`, other than the global ones.
+        """
+        escapes = []
+        for hashed in sorted(set(self._hash_re.findall(html)), key=html.index):
+            text = self._escapes_from_hash.get(hashed)
+            if text is not None and g_escape_table.get(text) != hashed:
+                escapes.append((text, hashed))
+        return tuple(escapes)
+
+    # Chunks continuing the block before them: indented lines (list item
+    # paragraphs, code blocks) and further list items or quotes.
+    _continuation_re = re.compile(r'[ \t]|[ ]{0,3}(?:[*+-]|\d+\.)[ \t]|[ \t]*>')
+    _list_or_quote_re = re.compile(r'^(?:[ ]{0,3}(?:[*+-]|\d+\.)[ \t]|[ \t]*>)', re.M)
+
+    def _split_blocks(self, text):
+        """Split a prepared document into top-level blocks, which the block
+        gamut converts independently of each other: chunks between blank
+        lines, merged while a chunk may continue a list, a block quote or an
+        indented code block.
+        """
+        blocks = []
+        # the blank lines are kept within a block, e.g. in code blocks
+        parts = re.split(r"(\n{2,})", text.strip("\n"))
+        for i in range(0, len(parts), 2):
+            chunk = parts[i]
+            if not chunk:
+                continue
+            if blocks and self._continuation_re.match(chunk) and (
+                    chunk[0] in " \t"
+                    or self._list_or_quote_re.search(blocks[-1])):
+                blocks[-1] += parts[i - 1] + chunk
+            else:
+                blocks.append(chunk)
+        return blocks
+
     def postprocess(self, text):
         """A hook for subclasses to do some postprocessing of the html, if
         desired. This is called before unescaping of special chars and
@@ -1538,35 +1661,11 @@ class Markdown(object):
         return list_str
 
     def _get_pygments_lexer(self, lexer_name):
-        try:
-            from pygments import lexers, util
-        except ImportError:
-            return None
-        try:
-            return lexers.get_lexer_by_name(lexer_name)
-        except util.ClassNotFound:
-            return None
+        return _get_pygments_lexer(lexer_name)
 
     def _color_with_pygments(self, codeblock, lexer, **formatter_opts):
-        import pygments.formatters
-
-        class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
-            def _wrap_code(self, inner):
-                """A function for use in a Pygments Formatter which
-                wraps in <code> tags.
-                """
-                yield 0, "<code>"
-                for tup in inner:
-                    yield tup
-                yield 0, "</code>"
-
-            def wrap(self, source, outfile):
-                """Return the source with a code, pre, and div."""
-                return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
-
         formatter_opts.setdefault("cssclass", "codehilite")
-        formatter = HtmlCodeFormatter(**formatter_opts)
-        return pygments.highlight(codeblock, lexer, formatter)
+        return _highlight(codeblock, lexer, formatter_opts)
 
     def _code_block_sub(self, match, is_fenced_code_block=False):
         lexer_name = None
@@ -2020,6 +2119,116 @@ class MarkdownWithExtras(Markdown):
     extras = ["footnotes", "code-color"]
 
 
+class BlockCache(object):
+    """A bounded cache of the HTML of converted blocks for
+    `Markdown.convert_incremental()`, evicting the least recently used
+    blocks. It can be shared between threads.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# ---- Pygments support
+
+# Pygments is imported on the first code block to highlight: None until
+# then, False if it isn't installed.
+_pygments = None
+_HtmlCodeFormatter = None
+
+# lexer name => lexer, or False for the names Pygments doesn't know
+_pygments_lexers = BlockCache(PYGMENTS_LEXER_CACHE_SIZE)
+# (lexer, formatter options, code) => highlighted HTML
+_highlighted = BlockCache(PYGMENTS_CACHE_SIZE)
+
+
+def _load_pygments():
+    global _pygments, _HtmlCodeFormatter
+    if _pygments is None:
+        try:
+            import pygments
+            import pygments.formatters
+            import pygments.lexers
+            import pygments.util
+        except ImportError:
+            _pygments = False
+            return _pygments
+
+        class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
+            def _wrap_code(self, inner):
+                """A function for use in a Pygments Formatter which
+                wraps in <code> tags.
+                """
+                yield 0, "<code>"
+                for tup in inner:
+                    yield tup
+                yield 0, "</code>"
+
+            def wrap(self, source, outfile=None):
+                """Return the source with a code, pre, and div."""
+                if outfile is None:
+                    # Pygments >= 2.12 calls wrap(source) and adds the div
+                    return self._wrap_pre(self._wrap_code(source))
+                return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
+
+        _HtmlCodeFormatter = HtmlCodeFormatter
+        _pygments = pygments
+    return _pygments
+
+
+def _get_pygments_lexer(lexer_name):
+    lexer = _pygments_lexers.get(lexer_name)
+    if lexer is None:
+        pygments = _load_pygments()
+        if not pygments:
+            return None
+        try:
+            lexer = pygments.lexers.get_lexer_by_name(lexer_name)
+        except pygments.util.ClassNotFound:
+            lexer = False
+        _pygments_lexers.set(lexer_name, lexer)
+    return lexer or None
+
+
+def _highlight(codeblock, lexer, formatter_opts):
+    """Highlight `codeblock` with `lexer`, reusing the HTML of the code
+    blocks highlighted before with the same lexer and options.
+    """
+    # the options may hold lists (e.g. "hl_lines"), so they are keyed by repr
+    key = (lexer.__class__, repr(sorted(lexer.options.items())),
+           repr(sorted(formatter_opts.items())), codeblock)
+    html = _highlighted.get(key)
+    if html is None:
+        pygments = _load_pygments()
+        html = pygments.highlight(codeblock, lexer,
+                                  _HtmlCodeFormatter(**formatter_opts))
+        _highlighted.set(key, html)
+    return html
+
+
 # ---- internal support functions
 
 class UnicodeWithAttrs(unicode):
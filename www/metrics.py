@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+in-process metrics, rendered in the Prometheus text exposition format.
+
+with several worker processes (see share()) every worker writes a snapshot of its samples to a file once per
+monitor interval, and render() exposes the samples of all the workers with a `worker` label (their pid),
+so every scrape sees monotonic counters of every worker, whichever worker answers it.
+"""
+import asyncio
+import bisect
+import json
+import logging
+import os
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def samples(self):
+        """yield (suffix, label values, extra label, value) of every sample"""
+        for key, value in self._values.items():
+            yield "", key, None, value
+
+    def render(self, workers=None):
+        """the samples of this process, or with `workers` ({pid: samples}) those of every worker labelled by pid"""
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.type)]
+        if workers is None:
+            workers = {None: self.samples()}
+        for worker, samples in workers.items():
+            for suffix, key, extra, value in samples:
+                if worker is not None:
+                    worker_label = 'worker="{}"'.format(worker)
+                    extra = worker_label if extra is None else extra + "," + worker_label
+                lines.append("{}{}{} {}".format(self.name, suffix, _format_labels(self.labels, key, extra),
+                                                _format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """a gauge which is either set directly, or read from `func()` returning {label values: value} when rendered"""
+    type = "gauge"
+
+    def __init__(self, name, documentation, labels=(), func=None):
+        super(Gauge, self).__init__(name, documentation, labels)
+        self.func = func
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def get(self, *labels):
+        return self._values.get(labels, 0)
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def samples(self):
+        if self.func is not None:
+            try:
+                self._values = dict(self.func())
+            except Exception as e:
+                logging.exception(e)
+        return super(Gauge, self).samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            # [count per bucket (the last one is +Inf), sum]
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", key, 'le="{}"'.format(_format_value(bound)), cumulative
+            yield "_sum", key, None, total
+            yield "_count", key, None, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        """{metric name: samples} of this process"""
+        return {metric.name: list(metric.samples()) for metric in self._metrics}
+
+    def render(self):
+        if _share_dir is None:
+            return "\n".join(metric.render() for metric in self._metrics) + "\n"
+        snapshots = read_snapshots()
+        return "\n".join(metric.render({pid: snapshot["metrics"].get(metric.name, ())
+                                         for pid, snapshot in snapshots.items()})
+                         for metric in self._metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+# the directory of the snapshots of the workers, None in a single process
+_share_dir = None
+
+# name => function returning json serializable data of this process, written in its snapshot
+_snapshot_funcs = {}
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+requests_total = REGISTRY.register(Counter(
+        "http_requests_total", "HTTP requests by route and status.", ("method", "route", "status")))
+requests_in_flight = REGISTRY.register(Gauge(
+        "http_requests_in_flight", "HTTP requests being handled.", ("method", "route")))
+request_duration = REGISTRY.register(Histogram(
+        "http_request_duration_seconds", "HTTP request latency by route.", ("method", "route")))
+event_loop_lag = REGISTRY.register(Gauge(
+        "event_loop_lag_seconds", "Delay of the last event loop monitor wakeup."))
+event_loop_tasks = REGISTRY.register(Gauge(
+        "event_loop_tasks", "Pending asyncio tasks.", func=lambda: {(): len(asyncio.all_tasks())}))
+process_cpu = REGISTRY.register(Gauge(
+        "process_cpu_usage_ratio", "CPU time used by the process per second over the last monitor interval."))
+
+
+def observe_request(method, route, status, elapsed):
+    requests_total.inc(method, route, str(status))
+    request_duration.observe(elapsed, method, route)
+
+
+async def monitor_event_loop(interval=1.0):
+    """measure how late the event loop wakes up a sleeping task, which is the time other callbacks block it"""
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        cpu_start = time.process_time()
+        await asyncio.sleep(interval)
+        elapsed = loop.time() - start
+        event_loop_lag.set(max(elapsed - interval, 0.0))
+        process_cpu.set((time.process_time() - cpu_start) / elapsed)
+        if _share_dir is not None:
+            try:
+                write_snapshot()
+            except Exception as e:
+                logging.exception(e)
+
+
+def share(directory):
+    """called by the master process before it forks the workers, which then write their snapshots to `directory`"""
+    global _share_dir
+    _share_dir = directory
+
+
+def add_snapshot(name, func):
+    """also write `func()` in the snapshots, read back from every worker by worker_snapshots(name)"""
+    _snapshot_funcs[name] = func
+
+
+def _snapshot():
+    ret = {name: func() for name, func in _snapshot_funcs.items()}
+    ret["metrics"] = REGISTRY.snapshot()
+    return ret
+
+
+def write_snapshot():
+    path = os.path.join(_share_dir, "{}.json".format(os.getpid()))
+    with open(path + ".tmp", "w") as f:
+        json.dump(_snapshot(), f)
+    os.replace(path + ".tmp", path)
+
+
+def read_snapshots():
+    """{pid: snapshot} of the running workers, the one of this process is taken now"""
+    own = str(os.getpid())
+    ret = {}
+    for filename in os.listdir(_share_dir):
+        pid, ext = os.path.splitext(filename)
+        if ext != ".json" or not pid.isdigit() or pid == own:
+            continue
+        path = os.path.join(_share_dir, filename)
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            # an exited worker, its replacement has another pid
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path) as f:
+                ret[pid] = json.load(f)
+        except (OSError, ValueError):
+            continue
+    ret[own] = _snapshot()
+    return dict(sorted(ret.items(), key=lambda item: int(item[0])))
+
+
+def worker_snapshots(name):
+    """{pid: data} of the snapshot `name` of every worker, of this process only if it's the single one"""
+    if _share_dir is None:
+        return {str(os.getpid()): _snapshot_funcs[name]()}
+    return {pid: snapshot.get(name) for pid, snapshot in read_snapshots().items()}
+
+
+def cpu_usage():
+    """the last measured process_cpu, 0 until monitor_event_loop is running"""
+    return process_cpu.get()
+
+
+def render():
+    return REGISTRY.render()
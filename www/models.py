@@ -4,14 +4,14 @@
 import time
 import uuid
 
-from www.orm import Model, StringField, BooleanField, FloatField, TextField
+from www.orm import SlotModel, StringField, BooleanField, FloatField, TextField
 
 
 def next_id() -> str:
     return "%018d%s" % (int(time.time() * 1000000), uuid.uuid4().hex)
 
 
-class User(Model):
+class User(SlotModel):
     __table__ = "users"
 
     id = StringField(primary_key=True, default=next_id, ddl="varchar(50)")
@@ -26,7 +26,7 @@ class User(Model):
         self.password = "********"
 
 
-class Blog(Model):
+class Blog(SlotModel):
     __table__ = "blogs"
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
@@ -37,11 +37,21 @@ class Blog(Model):
     created_at = FloatField(default=time.time)
 
 
-class Comment(Model):
+class Comment(SlotModel):
     __table__ = 'comments'
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
     content = TextField()
+    # the html of `content`, rendered when the comment is saved
+    html_content = TextField(default="")
+    created_at = FloatField(default=time.time)
+
+
+class RenderedMarkdown(SlotModel):
+    __table__ = 'rendered_markdown'
+
+    id = StringField(primary_key=True, ddl='varchar(40)')
+    html = TextField()
     created_at = FloatField(default=time.time)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+cpu bound work moved off the event loop: a process pool for the work which holds the GIL for long
+(markdown rendering), a thread pool for the work which is short but shouldn't stall the loop
+(large templates and json).
+
+at most `max_pending` calls run or wait in each pool, further callers wait for a slot before submitting,
+so a burst of heavy requests queues in the loop instead of piling up in the executors.
+until setup() is called, and for a pool of size 0, the functions run inline.
+"""
+import asyncio
+import functools
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class _Pool:
+    def __init__(self, executor, max_pending):
+        self.executor = executor
+        self.semaphore = asyncio.Semaphore(max_pending)
+        self.pending = 0
+        self.waiting = 0
+
+    async def run(self, func, *args):
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.pending += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self.executor, functools.partial(func, *args))
+        finally:
+            self.pending -= 1
+            self.semaphore.release()
+
+
+_processes = None
+_threads = None
+
+
+def _process_pool(processes, max_pending):
+    # the serving process has threads (logging, database), so the pool processes aren't forked from it
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    pool = _Pool(ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context(method)), max_pending)
+    pool.options = (processes, max_pending)
+    return pool
+
+
+def setup(processes=2, threads=4, max_pending=32):
+    """create the pools, in the serving process since pools don't survive fork"""
+    global _processes, _threads
+    shutdown()
+    if processes:
+        _processes = _process_pool(processes, max_pending)
+    if threads:
+        _threads = _Pool(ThreadPoolExecutor(threads, thread_name_prefix="offload"), max_pending)
+    logging.info("offload pools: %d processes, %d threads", processes, threads)
+
+
+def shutdown():
+    global _processes, _threads
+    for pool in (_processes, _threads):
+        if pool is not None:
+            pool.executor.shutdown(wait=False)
+    _processes = _threads = None
+
+
+async def in_process(func, *args):
+    """await `func(*args)` run in the process pool, `func` and its arguments must be picklable"""
+    global _processes
+    pool = _processes
+    if pool is None:
+        return func(*args)
+    try:
+        return await pool.run(func, *args)
+    except BrokenProcessPool:
+        # a pool process died, e.g. killed for its memory: this call runs inline and the pool is replaced
+        logging.exception("offload process pool broken, running %s inline", func.__name__)
+        if _processes is pool:
+            _processes = _process_pool(*pool.options)
+            pool.executor.shutdown(wait=False)
+        return func(*args)
+
+
+async def in_thread(func, *args):
+    """await `func(*args)` run in the thread pool"""
+    if _threads is None:
+        return func(*args)
+    return await _threads.run(func, *args)
+
+
+def stats():
+    ret = {}
+    for name, pool in (("process", _processes), ("thread", _threads)):
+        if pool is not None:
+            ret[name + "_pending"] = pool.pending
+            ret[name + "_waiting"] = pool.waiting
+    return ret
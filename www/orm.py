@@ -1,53 +1,707 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import asyncio
+import base64
+import contextvars
+import json
 import logging
+import multiprocessing
+import re
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 
-import aioodbc
+from www.logs import sql_logger
 
-_pool = None
+_backend = None
+
+# SQLite limits the number of host parameters in one statement (999 by default)
+MAX_IN_ARGS = 500
+
+# the number of query shapes whose sql is cached per model
+MAX_CACHED_STATEMENTS = 256
+
+# rows passed to one executemany call by execute_many
+BATCH_SIZE = 1000
+
+# rows fetched at once by iterate
+ITER_BATCH_SIZE = 500
+
+# seconds before a cached table row count is refreshed from the database
+COUNT_CACHE_TTL = 60
+
+# seconds above which a statement is logged as a slow query, None to disable
+SLOW_QUERY_THRESHOLD = 0.1
+
+# latest latencies kept per statement for percentiles
+STATS_SAMPLES = 1024
+
+# normalized sql => StatementStats
+_statement_stats = {}
+
+# sql => normalized sql
+_normalized_sql = {}
+
+# table name => [row count, refreshed at]
+_counts = {}
+
+# called as listener(model_class, primary_keys) after rows are written through a model
+_change_listeners = []
+
+# the model classes, in the order of their definition
+_models = []
+
+# with several worker processes, see share_changes(): the number of changes of each model in all workers,
+# and the numbers up to which this worker has notified them
+_shared_changes = None
+_seen_changes = None
+
+# the connection pinned by session() or transaction() for the current task
+_connection = contextvars.ContextVar("connection", default=None)
+
+# the changes made in the current transaction, notified after it commits
+_pending_changes = contextvars.ContextVar("pending_changes", default=None)
 
 
 def log(sql, args=()):
-    logging.info("SQL: {} ARGS: {}".format(sql, args))
+    if sql_logger.isEnabledFor(logging.INFO):
+        sql_logger.info("SQL: %s ARGS: %s", sql, args)
+
+
+_RE_ARGS_LIST = re.compile(r"\(\s*\?(\s*,\s*\?)+\s*\)")
+_RE_SPACES = re.compile(r"\s+")
+
+
+def normalize_sql(sql: str):
+    """the statement of `sql` for stats, with `in (?, ?, ...)` lists of any length collapsed"""
+    ret = _normalized_sql.get(sql)
+    if ret is None:
+        ret = _RE_ARGS_LIST.sub("(?, ...)", _RE_SPACES.sub(" ", sql.strip()))
+        if len(_normalized_sql) < 4096:
+            _normalized_sql[sql] = ret
+    return ret
+
+
+class StatementStats:
+    """counts, latencies and returned or affected rows of one normalized statement"""
+    __slots__ = ("sql", "count", "errors", "total", "max", "rows", "wait", "max_wait", "samples")
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        # time spent waiting for a connection, not included in the latencies
+        self.wait = 0.0
+        self.max_wait = 0.0
+        self.samples = deque(maxlen=STATS_SAMPLES)
+
+    def add(self, elapsed, rows, error=False, wait=0.0):
+        self.count += 1
+        self.total += elapsed
+        self.wait += wait
+        if wait > self.max_wait:
+            self.max_wait = wait
+        self.rows += rows
+        if error:
+            self.errors += 1
+        if elapsed > self.max:
+            self.max = elapsed
+        self.samples.append(elapsed)
+
+    def percentile(self, p):
+        """the p-th percentile of the latest latencies"""
+        samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        return samples[min(int(len(samples) * p / 100), len(samples) - 1)]
+
+    def to_dict(self):
+        return {
+            "sql":      self.sql,
+            "count":    self.count,
+            "errors":   self.errors,
+            "rows":     self.rows,
+            "total":    self.total,
+            "mean":     self.total / self.count if self.count else 0.0,
+            "p50":      self.percentile(50),
+            "p95":      self.percentile(95),
+            "p99":      self.percentile(99),
+            "max":      self.max,
+            "wait":     self.wait,
+            "max_wait": self.max_wait
+        }
+
+
+def record(sql, args, elapsed, rows, error=False, wait=0.0):
+    """
+    record the execution of a statement, which took `elapsed` seconds once it had a connection
+    after waiting `wait` seconds for it, and log each if it is longer than SLOW_QUERY_THRESHOLD.
+    """
+    key = normalize_sql(sql)
+    stats = _statement_stats.get(key)
+    if stats is None:
+        stats = _statement_stats[key] = StatementStats(key)
+    stats.add(elapsed, rows, error, wait)
+    if SLOW_QUERY_THRESHOLD is not None:
+        if elapsed >= SLOW_QUERY_THRESHOLD:
+            sql_logger.warning("slow query: %.3fs, %d rows\n\tsql: %s\n\targs: %s", elapsed, rows, sql, args)
+        if wait >= SLOW_QUERY_THRESHOLD:
+            sql_logger.warning("slow connection: waited %.3fs for a connection\n\tsql: %s", wait, sql)
+
+
+def _acquired(start):
+    """(seconds waited for a connection since `start`, the start of the statement)"""
+    now = time.perf_counter()
+    return now - start, now
+
+
+def get_stats():
+    """the stats of all statements, the most time consuming first"""
+    return sorted((stats.to_dict() for stats in _statement_stats.values()), key=lambda d: d["total"], reverse=True)
+
+
+def reset_stats():
+    _statement_stats.clear()
+
+
+class Backend:
+    """
+    a database backend hands out connections with `acquire`, which support:
+
+        await conn.select(sql, args, size=None) -> rows
+        await conn.execute(sql, args) -> affected rows
+        await conn.execute_many(sql, batches) -> affected rows, all batches of args lists in one transaction
+        async for rows in conn.iterate(sql, args, batch) -> lists of at most `batch` rows
+        await conn.begin(), conn.commit(), conn.rollback()
+
+    rows are sequences of column values in the order of the select statement.
+    """
+
+    @classmethod
+    async def create(cls, loop, database: str, **kwargs):
+        raise NotImplementedError
+
+    def acquire(self, readonly=False):
+        """async context manager of a connection, `readonly` connections must not be used for writing"""
+        raise NotImplementedError
+
+    def stats(self):
+        """{name: value} of the pool gauges"""
+        return {}
+
+    async def close(self):
+        pass
+
+
+class Connection:
+    """the transaction handling shared by the connections of all backends"""
+    in_transaction = False
+
+    async def select(self, sql, args, size=None):
+        raise NotImplementedError
+
+    async def execute(self, sql, args):
+        raise NotImplementedError
+
+    async def executemany(self, sql, args_list):
+        raise NotImplementedError
+
+    async def iterate(self, sql, args, batch):
+        raise NotImplementedError
+        yield
+
+    async def begin(self):
+        # immediate: take the write lock now, a deferred transaction which reads then writes fails
+        # without waiting (SQLITE_BUSY_SNAPSHOT) if another process committed in between
+        await self.execute("begin immediate", ())
+        self.in_transaction = True
+
+    async def commit(self):
+        try:
+            await self.execute("commit", ())
+        except:
+            # e.g. SQLITE_BUSY leaves the transaction open: end it, or every later write of the connection joins it
+            try:
+                await self.rollback()
+            except Exception:
+                logging.exception("failed to roll back after a failed commit")
+            raise
+        self.in_transaction = False
+
+    async def rollback(self):
+        self.in_transaction = False
+        await self.execute("rollback", ())
+
+    async def execute_many(self, sql, batches):
+        if self.in_transaction:
+            return await self._execute_batches(sql, batches)
+        await self.begin()
+        try:
+            affected = await self._execute_batches(sql, batches)
+        except:
+            await self.rollback()
+            raise
+        await self.commit()
+        return affected
+
+    async def _execute_batches(self, sql, batches):
+        affected = 0
+        for args_list in batches:
+            affected += await self.executemany(sql, args_list)
+        return affected
+
+
+class ODBCConnection(Connection):
+    def __init__(self, conn):
+        self._conn = conn
+
+    async def select(self, sql, args, size=None):
+        async with self._conn.cursor() as cur:
+            await cur.execute(sql, args or ())
+            return await (cur.fetchmany(size) if size else cur.fetchall())
+
+    async def execute(self, sql, args):
+        try:
+            async with self._conn.cursor() as cur:
+                await cur.execute(sql, args)
+                return cur.rowcount
+        except:
+            if not self.in_transaction:
+                await self._conn.rollback()
+            raise
+
+    async def executemany(self, sql, args_list):
+        async with self._conn.cursor() as cur:
+            await cur.executemany(sql, args_list)
+            return cur.rowcount if cur.rowcount >= 0 else len(args_list)
+
+    async def iterate(self, sql, args, batch):
+        async with self._conn.cursor() as cur:
+            await cur.execute(sql, args or ())
+            while True:
+                rows = await cur.fetchmany(batch)
+                if not rows:
+                    break
+                yield rows
+
+
+class ODBCBackend(Backend):
+    """SQLite through aioodbc and the SQLite3 ODBC driver"""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    @classmethod
+    async def create(cls, loop, database: str, **kwargs):
+        import aioodbc
+        # 需要安装SQLite ODBC驱动 http://www.ch-werner.de/sqliteodbc/
+        pool = await aioodbc.create_pool(dsn="DRIVER={SQLite3 ODBC Driver};Database=" + database, loop=loop,
+                                         autocommit=True, **kwargs)
+        return cls(pool)
+
+    @asynccontextmanager
+    async def acquire(self, readonly=False):
+        async with self._pool.acquire() as conn:
+            yield ODBCConnection(conn)
+
+    def stats(self):
+        return {"size": self._pool.size, "free": self._pool.freesize}
+
+    async def close(self):
+        self._pool.close()
+        await self._pool.wait_closed()
+
+
+class SQLiteConnection(Connection):
+    """a stdlib sqlite3 connection whose statements run in the executor of its backend"""
+
+    def __init__(self, backend, conn):
+        self._backend = backend
+        self._conn = conn
+
+    def _select(self, sql, args, size):
+        cur = self._conn.execute(sql, args or ())
+        try:
+            return cur.fetchmany(size) if size else cur.fetchall()
+        finally:
+            cur.close()
+
+    def _execute(self, sql, args):
+        cur = self._conn.execute(sql, args)
+        try:
+            return cur.rowcount
+        finally:
+            cur.close()
+
+    def _execute_many(self, sql, args_list):
+        cur = self._conn.executemany(sql, args_list)
+        try:
+            return cur.rowcount
+        finally:
+            cur.close()
+
+    async def select(self, sql, args, size=None):
+        return await self._backend.run(self._select, sql, args, size)
+
+    async def execute(self, sql, args):
+        return await self._backend.run(self._execute, sql, args)
+
+    async def executemany(self, sql, args_list):
+        return await self._backend.run(self._execute_many, sql, args_list)
+
+    async def iterate(self, sql, args, batch):
+        cur = await self._backend.run(self._conn.execute, sql, args or ())
+        try:
+            while True:
+                rows = await self._backend.run(cur.fetchmany, batch)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cur.close()
+
+    def close(self):
+        self._conn.close()
+
+
+class SQLiteBackend(Backend):
+    """
+    SQLite through the stdlib sqlite3 module in WAL mode, with a pool of read-only connections
+    and a single writer connection. statements run in a thread pool off the event loop.
+    """
+
+    def __init__(self, loop, database: str, readers=4):
+        self._loop = loop
+        self._executor = ThreadPoolExecutor(max_workers=readers + 1, thread_name_prefix="sqlite")
+        self._writer = SQLiteConnection(self, self._connect(database))
+        self._writer_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        self._readers_count = readers
+        for i in range(readers):
+            conn = self._connect(database)
+            conn.execute("pragma query_only = on")
+            self._readers.put_nowait(SQLiteConnection(self, conn))
+
+    @staticmethod
+    def _connect(database):
+        conn = sqlite3.connect(database, isolation_level=None, check_same_thread=False)
+        conn.execute("pragma journal_mode = wal")
+        conn.execute("pragma synchronous = normal")
+        return conn
+
+    @classmethod
+    async def create(cls, loop, database: str, **kwargs):
+        return cls(loop, database, **kwargs)
+
+    async def run(self, func, *args):
+        return await self._loop.run_in_executor(self._executor, func, *args)
+
+    @asynccontextmanager
+    async def acquire(self, readonly=False):
+        if readonly:
+            conn = await self._readers.get()
+            try:
+                yield conn
+            finally:
+                self._readers.put_nowait(conn)
+        else:
+            async with self._writer_lock:
+                yield self._writer
+
+    def stats(self):
+        return {
+            "readers":      self._readers_count,
+            "readers_free": self._readers.qsize(),
+            "writer_busy":  int(self._writer_lock.locked())
+        }
+
+    async def close(self):
+        async with self._writer_lock:
+            self._writer.close()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+        self._executor.shutdown()
+
+
+BACKENDS = {
+    "sqlite": SQLiteBackend,
+    "odbc":   ODBCBackend
+}
+
+
+async def create_pool(loop, database: str, backend="sqlite", **kwargs):
+    """create the database backend, extra arguments are passed to the backend, e.g. readers=4 for sqlite"""
+    logging.info("create database connection pool (backend: %s)...", backend)
+    global _backend
+    _backend = await BACKENDS[backend].create(loop, database, **kwargs)
+
+
+def pool_stats():
+    return _backend.stats() if _backend is not None else {}
+
+
+async def close_pool():
+    global _backend
+    if _backend is not None:
+        await _backend.close()
+        _backend = None
+
+
+@asynccontextmanager
+async def _pinned(conn):
+    yield conn
+
+
+@asynccontextmanager
+async def session(readonly=False):
+    """
+    pin one connection for all queries in the block, e.g.:
 
+        async with orm.session():
+            blog = await Blog.find(id)
+            await comment.save_data()
 
-async def create_pool(loop, database: str):
-    logging.info("create database connection pool...")
-    global _pool
-    # 需要安装SQLite ODBC驱动 http://www.ch-werner.de/sqliteodbc/
-    _pool = await aioodbc.create_pool(dsn="DRIVER={SQLite3 ODBC Driver};Database=" + database, loop=loop,
-                                      autocommit=True)
+    nested sessions and transactions reuse the pinned connection.
+    """
+    conn = _connection.get()
+    if conn is not None:
+        yield conn
+        return
+    async with _backend.acquire(readonly) as conn:
+        token = _connection.set(conn)
+        try:
+            yield conn
+        finally:
+            _connection.reset(token)
+
+
+@asynccontextmanager
+async def transaction():
+    """
+    run all queries in the block on one connection in a transaction, which is committed at the end of the block
+    or rolled back if it raises. a nested transaction joins the outer one.
+    """
+    async with session() as conn:
+        if conn.in_transaction:
+            yield conn
+            return
+        # model class => primary keys of the changed rows
+        changes = {}
+        token = _pending_changes.set(changes)
+        try:
+            await conn.begin()
+            try:
+                yield conn
+            except:
+                await conn.rollback()
+                invalidate_count()
+                raise
+            try:
+                await conn.commit()
+            except:
+                # commit() rolled the transaction back
+                invalidate_count()
+                raise
+        finally:
+            _pending_changes.reset(token)
+        for model_class, primary_keys in changes.items():
+            notify_change(model_class, primary_keys)
 
 
 async def select(sql, args, size=None):
     log(sql, args)
-    async with _pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(sql, args or ())
-            ret = await (cur.fetchmany(size) if size else cur.fetchall())
-            logging.info("rows returned: %d", len(ret))
+    start = time.perf_counter()
+    wait = 0.0
+    ret = ()
+    try:
+        conn = _connection.get()
+        if conn is None:
+            async with _backend.acquire(readonly=True) as conn:
+                wait, start = _acquired(start)
+                ret = await conn.select(sql, args, size)
+        else:
+            ret = await conn.select(sql, args, size)
+    except:
+        record(sql, args, time.perf_counter() - start, 0, True, wait)
+        raise
+    record(sql, args, time.perf_counter() - start, len(ret), wait=wait)
+    sql_logger.debug("rows returned: %d", len(ret))
     return ret
 
 
+async def iterate(sql, args, batch=None):
+    """
+    select rows in lists of at most `batch` rows (ITER_BATCH_SIZE by default) fetched with fetchmany.
+    the connection is held until the iteration ends, close the generator when leaving it early.
+    """
+    batch = batch or ITER_BATCH_SIZE
+    log(sql, args)
+    # only the time spent fetching is recorded, not the time the consumer holds each batch
+    elapsed, count, error, wait = 0.0, 0, True, 0.0
+    start = time.perf_counter()
+    try:
+        # not through session(), which would pin the connection for the consumer too
+        conn = _connection.get()
+        async with _backend.acquire(readonly=True) if conn is None else _pinned(conn) as conn:
+            wait, start = _acquired(start)
+            async for rows in conn.iterate(sql, args, batch):
+                elapsed += time.perf_counter() - start
+                count += len(rows)
+                yield rows
+                start = time.perf_counter()
+        error = False
+    finally:
+        record(sql, args, elapsed + time.perf_counter() - start, count, error, wait)
+
+
 async def execute(sql, args):
     log(sql, args)
-    async with _pool.acquire() as conn:
-        # await conn.begin()
+    start = time.perf_counter()
+    wait = 0.0
+    try:
+        conn = _connection.get()
+        if conn is None:
+            async with _backend.acquire() as conn:
+                wait, start = _acquired(start)
+                affected = await conn.execute(sql, args)
+        else:
+            affected = await conn.execute(sql, args)
+    except:
+        record(sql, args, time.perf_counter() - start, 0, True, wait)
+        raise
+    record(sql, args, time.perf_counter() - start, affected, wait=wait)
+    return affected
+
+
+async def execute_many(sql, args_list, batch_size=None):
+    """
+    execute `sql` for every args in `args_list` with executemany in batches of `batch_size` (BATCH_SIZE by default),
+    all in a single transaction. returns the number of affected rows.
+    """
+    batch_size = batch_size or BATCH_SIZE
+    log(sql, "<{} rows in batches of {}>".format(len(args_list), batch_size))
+    batches = (args_list[i:i + batch_size] for i in range(0, len(args_list), batch_size))
+    start = time.perf_counter()
+    wait = 0.0
+    try:
+        async with session() as conn:
+            wait, start = _acquired(start)
+            affected = await conn.execute_many(sql, batches)
+    except:
+        record(sql, "<{} rows>".format(len(args_list)), time.perf_counter() - start, 0, True, wait)
+        raise
+    record(sql, "<{} rows>".format(len(args_list)), time.perf_counter() - start, affected, wait=wait)
+    return affected
+
+
+def adjust_count(table, delta):
+    """apply a change of `delta` rows to the cached row count of `table`"""
+    cached = _counts.get(table)
+    if cached is not None:
+        cached[0] = max(cached[0] + delta, 0)
+
+
+def invalidate_count(table=None):
+    """drop the cached row count of `table`, or of all tables"""
+    if table is None:
+        _counts.clear()
+    else:
+        _counts.pop(table, None)
+
+
+def add_change_listener(listener):
+    """
+    register listener(model_class, primary_keys) to be called after rows are inserted, updated or removed,
+    with the frozenset of their primary keys: once per statement or batch, or once per model class
+    at the commit of a transaction. primary_keys is None for the changes made by another worker process,
+    whose rows are unknown.
+    """
+    _change_listeners.append(listener)
+
+
+def _call_listeners(model_class, primary_keys):
+    for listener in _change_listeners:
         try:
-            async with conn.cursor() as cur:
-                await cur.execute(sql, args)
-                affected = cur.rowcount
-                # await conn.commit()
-                return affected
-        except:
-            await conn.rollback()
-            raise
+            listener(model_class, primary_keys)
+        except Exception as e:
+            logging.exception(e)
+
+
+def share_changes():
+    """
+    count the changes of every model in shared memory, called by the master process before it forks the workers.
+    a change committed by a worker is then notified in the others by their next sync_changes().
+    """
+    global _shared_changes, _seen_changes
+    _shared_changes = multiprocessing.Array("Q", len(_models))
+    _seen_changes = [0] * len(_models)
+
+
+def _publish_change(model_class):
+    index = model_class.__model_index__
+    with _shared_changes.get_lock():
+        seen = _shared_changes[index]
+        _shared_changes[index] = seen + 1
+    # the changes of the other workers counted before this one are still to be notified
+    if _seen_changes[index] == seen:
+        _seen_changes[index] = seen + 1
+
+
+def sync_changes():
+    """
+    notify the changes committed by the other workers since the last call, as changes of unknown rows,
+    and drop the cached row counts of their tables. called at the start of every request.
+    """
+    if _shared_changes is None:
+        return
+    changes = _shared_changes[:]
+    if changes == _seen_changes:
+        return
+    for index, count in enumerate(changes):
+        if count != _seen_changes[index]:
+            _seen_changes[index] = count
+            invalidate_count(_models[index].__table__)
+            _call_listeners(_models[index], None)
+
+
+def notify_change(model_class, primary_keys):
+    """call the change listeners for the rows of `primary_keys`, or defer the call to the commit of the transaction"""
+    pending = _pending_changes.get()
+    if pending is not None:
+        pending.setdefault(model_class, set()).update(primary_keys)
+        return
+    _call_listeners(model_class, frozenset(primary_keys))
+    if _shared_changes is not None:
+        _publish_change(model_class)
 
 
 def create_args_string(num):
     return ", ".join(["?"] * num)
 
 
+def encode_cursor(values):
+    """encode the seek values of the last row into an opaque pagination cursor"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    """decode a pagination cursor, raises ValueError if it is malformed"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode())
+    except Exception:
+        raise ValueError("Invalid cursor: {}".format(cursor))
+    # [seek value, primary key], which are bound as sql arguments
+    if not isinstance(values, list) or len(values) != 2 or \
+            not all(type(value) in (str, int, float) for value in values):
+        raise ValueError("Invalid cursor: {}".format(cursor))
+    return values
+
+
 class Field:
     def __init__(self, name, column_type, primary_key, default):
         self.name = name
@@ -90,9 +744,12 @@ class StandardError(Exception):
     pass
 
 
+_MISSING = object()
+
+
 class ModelMetaclass(type):
     def __new__(mcs, name, bases, attrs):
-        if name == "Model":
+        if name in ("ModelBase", "Model", "SlotModel"):
             return type.__new__(mcs, name, bases, attrs)
         table_name = attrs.get("__table__", None) or name
         logging.info("found model: %s (table: %s)", name, table_name)
@@ -118,31 +775,37 @@ class ModelMetaclass(type):
         attrs["__table__"] = table_name
         attrs["__primary_key__"] = primary_key
         attrs["__fields__"] = fields
+        attrs["__columns__"] = tuple([primary_key] + fields)
         attrs["__select__"] = "select `{}`, {} from `{}`".format(primary_key, escaped_fields, table_name)
+        attrs["__find__"] = "{} where `{}`=?".format(attrs["__select__"], primary_key)
+        attrs["__sql_cache__"] = {}
         attrs["__insert__"] = "insert into `{}` ({}, `{}`) values ({})".format(table_name, escaped_fields, primary_key,
                                                                                create_args_string(len(fields) + 1))
+        # not `insert or replace`, which deletes the rows conflicting on any unique column, not only the primary key
+        attrs["__upsert__"] = "insert into `{}` ({}, `{}`) values ({}) on conflict(`{}`) do update set {}".format(
+                table_name, escaped_fields, primary_key, create_args_string(len(fields) + 1), primary_key,
+                ", ".join("`{0}`=excluded.`{0}`".format(field) for field in fields))
         attrs["__update__"] = "update `{}` set {} where `{}`=?".format(
                 table_name, ', '.join(["`{}`=?".format(mappings.get(field).name or field) for field in fields]),
                 primary_key)
         attrs["__delete__"] = "delete from `{}` where `{}`=?".format(table_name, primary_key)
+        if any(getattr(base, "__slotted__", False) for base in bases):
+            # one slot per column, and a lazily created __dict__ for attachments such as `user`
+            attrs["__slots__"] = attrs["__columns__"] + ("__dict__",)
         return type.__new__(mcs, name, bases, attrs)
 
     def __init__(cls, name, bases, attrs):
         super(ModelMetaclass, cls).__init__(name, bases, attrs)
+        if "__slots__" in attrs and "__columns__" in attrs:
+            cls.__setters__ = tuple(getattr(cls, column).__set__ for column in cls.__columns__)
+        if "__columns__" in attrs:
+            cls.__model_index__ = len(_models)
+            _models.append(cls)
 
 
-class Model(dict, metaclass=ModelMetaclass):
-    def __init__(self, **kwargs):
-        super(Model, self).__init__(**kwargs)
-
-    def __getattr__(self, key):
-        try:
-            return self[key]
-        except KeyError:
-            raise AttributeError("'Model' object has no attribute `{}`".format(key))
-
-    def __setattr__(self, key, value):
-        self[key] = value
+class ModelBase(metaclass=ModelMetaclass):
+    """the queries shared by Model and SlotModel"""
+    __slots__ = ()
 
     def get_value(self, key):
         return getattr(self, key, None)
@@ -157,42 +820,116 @@ class Model(dict, metaclass=ModelMetaclass):
                 setattr(self, key, value)
         return value
 
+    @classmethod
+    def get_sql(cls, shape, build):
+        """get the sql of a query shape, `build()` is only called the first time a shape is seen"""
+        sql = cls.__sql_cache__.get(shape)
+        if sql is None:
+            sql = build()
+            if len(cls.__sql_cache__) < MAX_CACHED_STATEMENTS:
+                cls.__sql_cache__[shape] = sql
+        return sql
+
+    @classmethod
+    def get_select(cls, where: str = None, args: list = None, order_by: str = None, limit=None):
+        """get the sql and args of a select by where clause, order by and limit"""
+        args = list(args or [])
+        if limit is None:
+            limit_shape = None
+        elif isinstance(limit, int):
+            limit_shape = "?"
+            args.append(limit)
+        elif isinstance(limit, (tuple, list)) and len(limit) == 2:
+            limit_shape = "?, ?"
+            args.extend(limit)
+        else:
+            raise ValueError("Invalid limit value: %s", str(limit))
+
+        def build():
+            sql = [cls.__select__]
+            if where:
+                sql.append("where")
+                sql.append(where)
+            if order_by:
+                sql.append("order by")
+                sql.append(order_by)
+            if limit_shape:
+                sql.append("limit")
+                sql.append(limit_shape)
+            return " ".join(sql)
+
+        return cls.get_sql(("select", where, order_by, limit_shape), build), args
+
     @classmethod
     async def find_all(cls, where: str = None, args: list = None, **kwargs):
         """
         find objects by where clause.
         """
-        sql = [cls.__select__]
+        sql, args = cls.get_select(where, args, kwargs.get("orderBy", None), kwargs.get("limit", None))
+        return list(map(cls.from_row, await select(sql, args)))
 
-        if where:
-            sql.append("where")
-            sql.append(where)
+    @classmethod
+    async def iter_all(cls, where: str = None, args: list = None, batch: int = None, **kwargs):
+        """
+        iterate over objects by where clause, fetching `batch` rows at a time so that memory stays flat:
+
+            async for comment in Comment.iter_all(orderBy="created_at"):
+                ...
+        """
+        sql, args = cls.get_select(where, args, kwargs.get("orderBy", None), kwargs.get("limit", None))
+        from_row = cls.from_row
+        async for rows in iterate(sql, args, batch):
+            for row in rows:
+                yield from_row(row)
+
+    @classmethod
+    async def find_page(cls, where: str = None, args: list = None, cursor: str = None, limit: int = 10,
+                        seek_field: str = "created_at"):
+        """
+        find objects in descending `seek_field` order with keyset pagination,
+        returns the objects and the cursor of the next page (None for the last page).
+        """
+        primary_key = cls.__primary_key__
+        conditions = ["({})".format(where)] if where else []
+        args = list(args or [])
+        if cursor:
+            value, key = decode_cursor(cursor)
+            conditions.append("(`{0}` < ? or (`{0}` = ? and `{1}` < ?))".format(seek_field, primary_key))
+            args.extend([value, value, key])
+        ret = await cls.find_all(" and ".join(conditions) or None, args,
+                                 orderBy="`{}` desc, `{}` desc".format(seek_field, primary_key), limit=limit + 1)
+        if len(ret) <= limit:
+            return ret, None
+        ret = ret[:limit]
+        last = ret[-1]
+        return ret, encode_cursor([last.get_value(seek_field), last.get_value(primary_key)])
 
-        args = args or []
-
-        order_by = kwargs.get("orderBy", None)
-        if order_by:
-            sql.append("order by")
-            sql.append(order_by)
-
-        limit = kwargs.get("limit", None)
-        if limit is not None:
-            sql.append("limit")
-            if isinstance(limit, int):
-                sql.append("?")
-            elif isinstance(limit, (tuple, list)) and len(limit) == 2:
-                sql.append("?, ?")
-                args.extend(limit)
-            else:
-                raise ValueError("Invalid limit value: %s", str(limit))
-        ret = []
-        for row in await select(" ".join(sql), args):
-            kwargs = {}
-            for i, field in enumerate(row.cursor_description):
-                kwargs[field[0]] = row[i]
-            ret.append(cls(**kwargs))
+    @classmethod
+    async def find_many(cls, primary_keys):
+        """
+        find objects by a list of primary keys with `in (...)` queries, returns a dict keyed by primary key.
+        """
+        keys = list(set(key for key in primary_keys if key is not None))
+        ret = {}
+        for i in range(0, len(keys), MAX_IN_ARGS):
+            batch = keys[i:i + MAX_IN_ARGS]
+            sql = cls.get_sql(("find_many", len(batch)), lambda: "{} where `{}` in ({})".format(
+                    cls.__select__, cls.__primary_key__, create_args_string(len(batch))))
+            for row in await select(sql, batch):
+                ret[row[0]] = cls.from_row(row)
         return ret
 
+    @classmethod
+    async def attach(cls, items, key, name):
+        """
+        load the related objects of `items` whose primary keys are stored in `key` in a single batch,
+        and set them to attribute `name` of every item.
+        """
+        related = await cls.find_many(getattr(item, key) for item in items)
+        for item in items:
+            setattr(item, name, related.get(getattr(item, key)))
+        return related
+
     @classmethod
     async def find_number(cls, select_field, where: str = None, args: list = None):
         """find number by select and where"""
@@ -203,31 +940,66 @@ class Model(dict, metaclass=ModelMetaclass):
         ret = await select(" ".join(sql), args, 1)
         return ret[0][0] if len(ret) else None
 
+    @classmethod
+    async def find_count(cls, ttl=None):
+        """
+        count all rows of the table. the count is cached for `ttl` seconds (COUNT_CACHE_TTL by default)
+        and kept up to date by save_data and remove_data in between.
+        """
+        ttl = COUNT_CACHE_TTL if ttl is None else ttl
+        cached = _counts.get(cls.__table__)
+        if cached is not None and time.time() - cached[1] < ttl:
+            return cached[0]
+        num = await cls.find_number("count(`{}`)".format(cls.__primary_key__)) or 0
+        _counts[cls.__table__] = [num, time.time()]
+        return num
+
     @classmethod
     async def find(cls, primary_key):
         """find object by primary key"""
-        ret = await select("{} where `{}`=?".format(cls.__select__, cls.__primary_key__), [primary_key], 1)
-        if len(ret) == 0:
-            return None
-        else:
-            row = ret[0]
-            kwargs = {}
-            for i, field in enumerate(row.cursor_description):
-                kwargs[field[0]] = row[i]
-            return cls(**kwargs)
+        ret = await select(cls.__find__, [primary_key], 1)
+        return cls.from_row(ret[0]) if ret else None
 
-    async def save_data(self):
+    def get_args(self):
+        """the values of the fields followed by the primary key, as used by insert and update"""
         args = [self.get_value_or_default(field) for field in self.__fields__]
         args.append(self.get_value_or_default(self.__primary_key__))
+        return args
+
+    @classmethod
+    async def save_all(cls, objs, batch_size=None):
+        """insert objects with executemany in a single transaction, returns the number of inserted rows"""
+        args_list = [obj.get_args() for obj in objs]
+        rows = await execute_many(cls.__insert__, args_list, batch_size)
+        adjust_count(cls.__table__, rows)
+        notify_change(cls, [args[-1] for args in args_list])
+        return rows
+
+    @classmethod
+    async def upsert_all(cls, objs, batch_size=None):
+        """
+        insert objects, updating the rows with the same primary key instead, with executemany in a single transaction.
+        a conflict on another unique column raises. returns the number of affected rows.
+        """
+        args_list = [obj.get_args() for obj in objs]
+        rows = await execute_many(cls.__upsert__, args_list, batch_size)
+        invalidate_count(cls.__table__)
+        notify_change(cls, [args[-1] for args in args_list])
+        return rows
+
+    async def save_data(self):
+        args = self.get_args()
         rows = await execute(self.__insert__, args)
+        adjust_count(self.__table__, rows)
+        notify_change(self.__class__, (args[-1],))
         if rows != 1:
             logging.warning("failed to insert record: affected rows: {} \n\tsql: {}\n\targs: {}",
                             rows, self.__insert__, args)
 
     async def update_data(self):
-        args = [self.get_value_or_default(field) for field in self.__fields__]
-        args.append(self.get_value_or_default(self.__primary_key__))
+        args = self.get_args()
         rows = await execute(self.__update__, args)
+        notify_change(self.__class__, (args[-1],))
         if rows != 1:
             logging.warning("failed to update by primary key: affected rows: {} \n\tsql: {}\n\targs: {}",
                             rows, self.__update__, args)
@@ -235,6 +1007,70 @@ class Model(dict, metaclass=ModelMetaclass):
     async def remove_data(self):
         args = [self.get_value(self.__primary_key__)]
         rows = await execute(self.__delete__, args)
+        adjust_count(self.__table__, -rows)
+        notify_change(self.__class__, (args[-1],))
         if rows != 1:
             logging.warning("failed to remove by primary key: affected rows: {} \n\tsql: {}\n\targs: {}",
                             rows, self.__delete__, args)
+
+
+class Model(dict, ModelBase):
+    """a model which is a dict of its columns, attributes are read from and written to the items"""
+
+    def __init__(self, **kwargs):
+        super(Model, self).__init__(**kwargs)
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError("'Model' object has no attribute `{}`".format(key))
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+    @classmethod
+    def from_row(cls, row):
+        """build an object from a row whose columns are in `__columns__` order, as selected by `__select__`"""
+        obj = dict.__new__(cls)
+        dict.update(obj, zip(cls.__columns__, row))
+        return obj
+
+    def to_dict(self):
+        return dict(self)
+
+
+class SlotModel(ModelBase):
+    """
+    a compact model which stores its columns in __slots__, other attributes (e.g. `user`, `html_content`)
+    go to a __dict__ which is only created when the first of them is set.
+    """
+    __slots__ = ()
+    __slotted__ = True
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    @classmethod
+    def from_row(cls, row):
+        """build an object from a row whose columns are in `__columns__` order, as selected by `__select__`"""
+        obj = cls.__new__(cls)
+        for setter, value in zip(cls.__setters__, row):
+            setter(obj, value)
+        return obj
+
+    def to_dict(self):
+        """the columns which are set and the attached attributes, for serializing"""
+        ret = {}
+        for column in self.__columns__:
+            value = getattr(self, column, _MISSING)
+            if value is not _MISSING:
+                ret[column] = value
+        ret.update(self.__dict__)
+        return ret
+
+    def __str__(self):
+        return "<{} {}>".format(self.__class__.__name__, self.to_dict())
+
+    __repr__ = __str__
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import html
+import logging
+
+from www import markdown2, offload
+from www.cache import LRUCache
+from www.config import configs
+from www.models import RenderedMarkdown
+
+# content key => html
+_markdown_cache = LRUCache(configs.markdown.cache_size)
+# block hash => html of the block, shared by the documents rendered in this process
+_block_cache = markdown2.BlockCache(configs.markdown.block_cache_size)
+
+
+def text2html(text: str):
+    """the html of a plain text comment: one escaped paragraph per non blank line"""
+    return "\n".join("<p>{}</p>".format(html.escape(s))
+                     for s in text.split("\n") if s.strip())
+
+
+def markdown_key(content: str, extras=None):
+    """content address of the html rendered from `content` with `extras`"""
+    s = ",".join(sorted(extras or ())) + "\n" + content
+    return hashlib.sha1(s.encode()).hexdigest()
+
+
+def render_markdown(content: str, extras=None):
+    """render `content`, reusing the html of the blocks which didn't change since they were last rendered"""
+    return str(markdown2.Markdown(extras=extras).convert_incremental(content, _block_cache))
+
+
+async def preview_markdown(content: str, extras=None):
+    """render `content` without caching the whole html, for drafts"""
+    if len(content) >= configs.offload.markdown_min_size:
+        # on a thread so that the blocks cached in this process are reused from one preview to the next
+        return await offload.in_thread(render_markdown, content, extras)
+    return render_markdown(content, extras)
+
+
+async def markdown2html(content: str, extras=None):
+    """
+    get the html of markdown `content`, looking up the memory cache first, then the persisted cache
+    if configs.markdown.persist is set, and rendering it only when both miss.
+    """
+    key = markdown_key(content, extras)
+    ret = _markdown_cache.get(key)
+    if ret is not None:
+        return ret
+    if configs.markdown.persist:
+        row = await RenderedMarkdown.find(key)
+        if row is not None:
+            _markdown_cache.set(key, row.html)
+            return row.html
+    return await cache_markdown(content, extras)
+
+
+async def cache_markdown(content: str, extras=None):
+    """render markdown `content` and store the html in the caches, called when content is saved"""
+    key = markdown_key(content, extras)
+    if len(content) >= configs.offload.markdown_min_size:
+        ret = await offload.in_process(render_markdown, content, extras)
+    else:
+        ret = render_markdown(content, extras)
+    _markdown_cache.set(key, ret)
+    if configs.markdown.persist:
+        # concurrent first views render the same content: the same html replaces the row instead of failing
+        await RenderedMarkdown.upsert_all([RenderedMarkdown(id=key, html=ret)])
+    logging.info("cached rendered markdown: %s", key)
+    return ret
+
+
+async def uncache_markdown(content: str, extras=None):
+    """drop the cached html of markdown `content` which is no longer used"""
+    key = markdown_key(content, extras)
+    _markdown_cache.pop(key)
+    if configs.markdown.persist:
+        row = await RenderedMarkdown.find(key)
+        if row is not None:
+            await row.remove_data()
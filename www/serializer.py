@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+json serialization of api results to utf-8 bytes, with orjson if installed.
+
+objects which json can't encode go through an encoder built once per class:
+slotted models are encoded from their `__columns__`, classes declaring `__fields__` (e.g. apis.Page)
+from those attributes, other classes by their `to_dict()` or `__dict__`.
+"""
+import json
+import operator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# lists longer than this are encoded by iterencode() in chunks of STREAM_CHUNK_SIZE items
+STREAM_THRESHOLD = 1000
+STREAM_CHUNK_SIZE = 500
+
+_MISSING = object()
+
+# class => function returning a json serializable object
+_encoders = {}
+
+
+def register_encoder(cls, encoder):
+    """use `encoder(obj)` for instances of `cls`, it returns an object which can be json encoded"""
+    _encoders[cls] = encoder
+
+
+def _attrs_getter(names):
+    getter = operator.attrgetter(*names)
+    return getter if len(names) > 1 else lambda obj: (getter(obj),)
+
+
+def _model_encoder(cls):
+    columns = tuple(cls.__columns__)
+    getter = _attrs_getter(columns)
+
+    def encode(obj):
+        try:
+            ret = dict(zip(columns, getter(obj)))
+        except AttributeError:
+            # some columns are not set
+            ret = {column: value for column, value in ((c, getattr(obj, c, _MISSING)) for c in columns)
+                   if value is not _MISSING}
+        attached = obj.__dict__
+        if attached:
+            ret.update(attached)
+        return ret
+
+    return encode
+
+
+def _fields_encoder(cls):
+    fields = tuple(cls.__fields__)
+    getter = _attrs_getter(fields)
+    return lambda obj: dict(zip(fields, getter(obj)))
+
+
+def build_encoder(cls):
+    if getattr(cls, "__slotted__", False) and getattr(cls, "__columns__", None):
+        return _model_encoder(cls)
+    if getattr(cls, "__fields__", None):
+        return _fields_encoder(cls)
+    if hasattr(cls, "to_dict"):
+        return cls.to_dict
+    return operator.attrgetter("__dict__")
+
+
+def default(obj):
+    cls = type(obj)
+    encoder = _encoders.get(cls)
+    if encoder is None:
+        encoder = _encoders[cls] = build_encoder(cls)
+    return encoder(obj)
+
+
+if orjson is not None:
+    def dumps(obj):
+        return orjson.dumps(obj, default=default)
+else:
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=default)
+
+    def dumps(obj):
+        return _encoder.encode(obj).encode()
+
+
+def size_hint(obj):
+    """the number of items of `obj` if it is a list, or of the lists in `obj` if it is a dict"""
+    if isinstance(obj, dict):
+        return sum(len(value) for value in obj.values() if isinstance(value, (list, tuple)))
+    return len(obj) if isinstance(obj, (list, tuple)) else 0
+
+
+def should_stream(obj):
+    """if `obj` is a list, or a dict with a list, longer than STREAM_THRESHOLD"""
+    if isinstance(obj, dict):
+        return any(isinstance(value, (list, tuple)) and len(value) > STREAM_THRESHOLD for value in obj.values())
+    return isinstance(obj, (list, tuple)) and len(obj) > STREAM_THRESHOLD
+
+
+def _iterencode_list(items, chunk_size):
+    yield b"["
+    for start in range(0, len(items), chunk_size):
+        chunk = dumps(items[start:start + chunk_size])
+        yield chunk[1:-1] if start == 0 else b"," + chunk[1:-1]
+    yield b"]"
+
+
+def iterencode(obj, chunk_size=STREAM_CHUNK_SIZE):
+    """encode `obj` as chunks of bytes, the lists of `obj` (or `obj` itself) are encoded `chunk_size` items at a time"""
+    if isinstance(obj, (list, tuple)):
+        yield from _iterencode_list(obj, chunk_size)
+        return
+    if not isinstance(obj, dict):
+        yield dumps(obj)
+        return
+    yield b"{"
+    for i, (key, value) in enumerate(obj.items()):
+        prefix = dumps(str(key)) + b":"
+        if i:
+            prefix = b"," + prefix
+        if isinstance(value, (list, tuple)) and len(value) > chunk_size:
+            yield prefix
+            yield from _iterencode_list(value, chunk_size)
+        else:
+            yield prefix + dumps(value)
+    yield b"}"
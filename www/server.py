@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+pre-fork serving: a master process loads the application, then forks workers which serve it.
+
+signals of the master:
+    SIGHUP           restart the workers one by one, each is replaced once its successor is ready
+    SIGUSR1          forwarded to the workers, which reload their templates
+    SIGTERM, SIGINT  stop the workers gracefully and exit
+
+the workers don't share memory: app.main() sets up, before forking, the shared change counters
+(orm.share_changes) which keep their caches in sync and the snapshots (metrics.share) of their metrics.
+"""
+import gc
+import logging
+import os
+import select
+import signal
+import socket
+import time
+
+from www.logs import restart_logging, stop_logging
+
+MASTER_SIGNALS = (signal.SIGCHLD, signal.SIGHUP, signal.SIGUSR1, signal.SIGTERM, signal.SIGINT)
+
+# a worker exiting sooner than this after its start is restarted after restart_delay, to not fork in a loop
+MIN_WORKER_LIFETIME = 5.0
+
+
+def create_socket(host="127.0.0.1", port=9000, unix=None, reuse_port=False, backlog=1024, unix_mode=0o660):
+    """
+    a listening socket on `unix` if it is set (a socket file path), on host:port otherwise.
+    the socket file gets the permissions `unix_mode`, by default only its owner and group can connect.
+    """
+    if unix is not None:
+        if os.path.exists(unix):
+            os.unlink(unix)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(unix)
+        os.chmod(unix, unix_mode)
+    else:
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Supervisor:
+    """
+    fork `workers` processes running `serve(sock, ready)`, which serves on the listening socket `sock`
+    until SIGTERM and calls `ready()` once it accepts connections.
+
+    the socket is created by the master and shared by the workers, or with reuse_port (linux, tcp only)
+    each worker binds its own with SO_REUSEPORT and the kernel balances the connections between them.
+    everything loaded before run() is shared with the workers until they write to it,
+    gc.freeze() keeps the garbage collector from touching (and so copying) those objects.
+    """
+
+    def __init__(self, serve, workers=None, host="127.0.0.1", port=9000, unix=None, reuse_port=False,
+                 restart_delay=1.0, shutdown_timeout=10.0, ready_timeout=30.0, unix_mode=0o660):
+        self.serve = serve
+        self.workers = workers or os.cpu_count() or 1
+        self.address = {"host": host, "port": port, "unix": unix, "unix_mode": unix_mode}
+        self.reuse_port = reuse_port and unix is None and hasattr(socket, "SO_REUSEPORT")
+        self.restart_delay = restart_delay
+        self.shutdown_timeout = shutdown_timeout
+        self.ready_timeout = ready_timeout
+        self.sock = None
+        # pid => start time
+        self._pids = {}
+        self._stopping = False
+
+    def run(self):
+        if self.reuse_port:
+            # fail here if the port is in use instead of in every worker,
+            # the socket is closed since the kernel would also give it connections
+            create_socket(reuse_port=True, **self.address).close()
+        else:
+            self.sock = create_socket(**self.address)
+        signal.pthread_sigmask(signal.SIG_BLOCK, MASTER_SIGNALS)
+        gc.freeze()
+        logging.info("master %d starting %d workers on %s", os.getpid(), self.workers,
+                     self.address["unix"] or "{host}:{port}".format(**self.address))
+        for i in range(self.workers):
+            self.spawn()
+        while not self._stopping:
+            info = signal.sigtimedwait(MASTER_SIGNALS, 1.0)
+            if info is None or info.si_signo == signal.SIGCHLD:
+                self.reap()
+            elif info.si_signo == signal.SIGHUP:
+                self.rolling_restart()
+            elif info.si_signo == signal.SIGUSR1:
+                self.broadcast(signal.SIGUSR1)
+            else:
+                self._stopping = True
+        self.stop()
+
+    def spawn(self):
+        """fork a worker and wait until it is ready, return its pid or None if it exited before"""
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            self._run_worker(w)
+        os.close(w)
+        self._pids[pid] = time.monotonic()
+        try:
+            readable, _, _ = select.select([r], [], [], self.ready_timeout)
+            ready = bool(readable) and os.read(r, 1) == b"1"
+        finally:
+            os.close(r)
+        if not ready:
+            logging.warning("worker %d is not ready", pid)
+            return None
+        logging.info("worker %d ready", pid)
+        return pid
+
+    def _run_worker(self, ready_fd):
+        status = 0
+        try:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, MASTER_SIGNALS)
+            # the logging thread of the master doesn't exist in the worker
+            restart_logging()
+            sock = self.sock
+            if self.reuse_port:
+                sock = create_socket(reuse_port=True, **self.address)
+
+            def ready():
+                os.write(ready_fd, b"1")
+                os.close(ready_fd)
+
+            self.serve(sock, ready)
+        except BaseException:
+            logging.exception("worker %d failed", os.getpid())
+            status = 1
+        finally:
+            stop_logging()
+            os._exit(status)
+
+    def reap(self):
+        """collect the exited workers and start new ones in their place"""
+        while self._pids:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            started = self._pids.pop(pid, None)
+            if started is None or self._stopping:
+                continue
+            logging.warning("worker %d exited with status %d, restarting it", pid, os.waitstatus_to_exitcode(status))
+            if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                time.sleep(self.restart_delay)
+            self.spawn()
+
+    def broadcast(self, sig):
+        for pid in list(self._pids):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def rolling_restart(self):
+        logging.info("rolling restart of %d workers", len(self._pids))
+        for pid in list(self._pids):
+            if self.spawn() is None:
+                logging.error("rolling restart stopped, worker %d is kept", pid)
+                return
+            self._terminate([pid])
+
+    def _terminate(self, pids):
+        """stop `pids` with SIGTERM, and SIGKILL those which are still running after shutdown_timeout"""
+        for pid in pids:
+            self._pids.pop(pid, None)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + self.shutdown_timeout
+        pending = set(pids)
+        while pending:
+            for pid in list(pending):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0] != 0:
+                        pending.discard(pid)
+                except ChildProcessError:
+                    pending.discard(pid)
+            if pending and time.monotonic() > deadline:
+                for pid in pending:
+                    logging.warning("killing worker %d", pid)
+                    os.kill(pid, signal.SIGKILL)
+                deadline = float("inf")
+            time.sleep(0.05)
+
+    def stop(self):
+        logging.info("stopping %d workers", len(self._pids))
+        self._terminate(list(self._pids))
+        if self.sock is not None:
+            self.sock.close()
+        if self.address["unix"] is not None and os.path.exists(self.address["unix"]):
+            os.unlink(self.address["unix"])
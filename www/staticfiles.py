@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+static assets served from memory, precompressed with gzip (and brotli if installed) at startup.
+
+precompressed `.gz` / `.br` files next to the assets are used instead of compressing at startup,
+they can be built ahead with:
+
+    python -m www.staticfiles [static dir]
+"""
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import sys
+from email.utils import formatdate
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    "application/javascript", "application/json", "application/xml", "image/svg+xml", "image/x-icon",
+    "application/vnd.ms-fontobject", "font/ttf", "font/otf", "application/x-font-ttf", "application/font-sfnt"
+}
+
+COMPRESSED_SUFFIXES = {"gzip": ".gz", "br": ".br"}
+
+
+def is_compressible(content_type):
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+
+def compress(data, encoding, level=9):
+    if encoding == "gzip":
+        return gzip.compress(data, level, mtime=0)
+    if encoding == "br" and brotli is not None:
+        return brotli.compress(data, quality=11 if level >= 9 else level)
+    return None
+
+
+def parse_accept_encoding(header):
+    """the encodings accepted by an Accept-Encoding header, which don't have q=0"""
+    ret = set()
+    for item in (header or "").split(","):
+        parts = item.strip().split(";")
+        encoding = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if encoding and q > 0:
+            ret.add(encoding)
+    return ret
+
+
+class StaticAsset:
+    __slots__ = ("content_type", "modified", "version", "variants")
+
+    def __init__(self, data, content_type, modified):
+        self.content_type = content_type
+        self.modified = formatdate(int(modified), usegmt=True)
+        digest = hashlib.sha1(data).hexdigest()
+        self.version = digest[:10]
+        # encoding => (body, etag)
+        self.variants = {"identity": (data, '"{}"'.format(digest))}
+
+    def add_variant(self, encoding, body):
+        self.variants[encoding] = (body, '"{}-{}"'.format(self.variants["identity"][1][1:-1], encoding))
+
+    def choose(self, accept_encoding):
+        accepted = parse_accept_encoding(accept_encoding)
+        for encoding in ("br", "gzip"):
+            if encoding in accepted and encoding in self.variants:
+                return encoding
+        return "identity"
+
+    def etags(self):
+        return [etag for body, etag in self.variants.values()]
+
+
+class StaticAssets:
+    """
+    all files under `root` up to `max_size` bytes kept in memory with their compressed variants.
+    requests whose query has the current version (`?v=...`, as made by `url()`) are cached for `max_age`,
+    the others for `revalidate_age`, after which browsers revalidate them with their ETag.
+    """
+
+    def __init__(self, root, max_size=1024 * 1024, min_compress_size=256, max_age=31536000, revalidate_age=3600):
+        self.root = os.path.abspath(root)
+        self.max_size = max_size
+        self.min_compress_size = min_compress_size
+        self.max_age = max_age
+        self.revalidate_age = revalidate_age
+        self._assets = {}
+        self.load()
+
+    def load(self):
+        assets = {}
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                full = os.path.join(dirpath, filename)
+                if os.path.splitext(filename)[1] in COMPRESSED_SUFFIXES.values() or \
+                        os.path.getsize(full) > self.max_size:
+                    continue
+                name = os.path.relpath(full, self.root).replace(os.sep, "/")
+                assets[name] = self.load_asset(full)
+                total += sum(len(body) for body, etag in assets[name].variants.values())
+        self._assets = assets
+        logging.info("loaded %d static assets (%d bytes) from %s", len(assets), total, self.root)
+
+    def load_asset(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        asset = StaticAsset(data, content_type, os.path.getmtime(path))
+        if len(data) >= self.min_compress_size and is_compressible(content_type):
+            for encoding, suffix in COMPRESSED_SUFFIXES.items():
+                if os.path.isfile(path + suffix) and os.path.getmtime(path + suffix) >= os.path.getmtime(path):
+                    with open(path + suffix, "rb") as f:
+                        body = f.read()
+                else:
+                    body = compress(data, encoding)
+                if body is not None and len(body) < len(data):
+                    asset.add_variant(encoding, body)
+        return asset
+
+    def url(self, name):
+        """the url of asset `name`, versioned by its content so that it can be cached for max_age"""
+        asset = self._assets.get(name)
+        if asset is None:
+            return "/static/" + name
+        return "/static/{}?v={}".format(name, asset.version)
+
+    async def handle(self, request):
+        name = request.match_info["path"]
+        asset = self._assets.get(name)
+        if asset is None:
+            return self.handle_file(name)
+        encoding = asset.choose(request.headers.get("Accept-Encoding"))
+        body, etag = asset.variants[encoding]
+        versioned = request.query.get("v") == asset.version
+        headers = {
+            "ETag":          etag,
+            "Last-Modified": asset.modified,
+            "Cache-Control": "public, max-age={}{}".format(self.max_age if versioned else self.revalidate_age,
+                                                           ", immutable" if versioned else ""),
+            "Vary":          "Accept-Encoding"
+        }
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            if "*" in tags or any(tag in tags for tag in asset.etags()):
+                return web.Response(status=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        # aiohttp sends the Content-Length of the body but not the body itself for HEAD
+        resp = web.Response(body=body, headers=headers)
+        resp.content_type = asset.content_type
+        return resp
+
+    def handle_file(self, name):
+        """serve files which are too large to be kept in memory from disk"""
+        path = os.path.abspath(os.path.join(self.root, name))
+        if not path.startswith(self.root + os.sep) or not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        return web.FileResponse(path, headers={"Cache-Control": "public, max-age={}".format(self.revalidate_age)})
+
+
+def build(root):
+    """write the .gz (and .br with brotli) files of the compressible assets under `root`"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            if os.path.splitext(filename)[1] in COMPRESSED_SUFFIXES.values() or not is_compressible(content_type):
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            for encoding, suffix in COMPRESSED_SUFFIXES.items():
+                body = compress(data, encoding)
+                if body is not None and len(body) < len(data):
+                    with open(path + suffix, "wb") as f:
+                        f.write(body)
+                    print("{} => {} ({} => {} bytes)".format(path, path + suffix, len(data), len(body)))
+
+
+if __name__ == '__main__':
+    build(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))